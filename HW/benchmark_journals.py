@@ -0,0 +1,306 @@
+"""Benchmark suite for Digital Journal storages
+
+Compares JSON journals (hw03, hw04), CSV repository (hw04/journal_optimized.py), CSV with log and binary columnar
+repositories (hw08) on the same synthetic students. Every operation is timed on the storage of given size, results
+are printed as a table and saved as JSON, so they can be compared between runs:
+    python HW/benchmark_journals.py --sizes 1000 100000 1000000 --ops 10 --output results.json
+"""
+from abc import ABC, abstractmethod
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HW_DIR = Path(__file__).resolve().parent
+SIZES = (1_000, 100_000, 1_000_000)
+OPERATIONS = ('load', 'add', 'grade', 'update', 'delete', 'daily_average')
+MARKS_PER_STUDENT = 10
+
+
+def import_journal(relative_path: str):
+    """Imports journal module by its path, as all of them are named the same"""
+    path = HW_DIR / relative_path
+    sys.path.insert(0, str(path.parent))  # for imports of neighbour modules (e.g. mail_server)
+    spec = importlib.util.spec_from_file_location(relative_path.replace('/', '_').removesuffix('.py'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.path.pop(0)
+    return module
+
+
+def generate_students(number_of_students: int):
+    """Yields (id, student) pairs, each student has MARKS_PER_STUDENT marks for the last days"""
+    today = datetime.date.today()
+    for i in range(number_of_students):
+        yield i + 1, {'name': f'Student {i + 1}',
+                      'info': '',
+                      'marks': [(today - datetime.timedelta(days=j), random.randint(1, 12)) for j in range(MARKS_PER_STUDENT)]}
+
+
+# ######################################################################################################################
+# Storages
+# ######################################################################################################################
+class JournalStorage(ABC):
+    """Common interface for benchmarked storages"""
+    name = ''
+    persistent = True  # whether changes are written to disk right away
+
+    @abstractmethod
+    def prepare(self, directory: str, number_of_students: int):
+        """Writes storage file with students, it is not timed"""
+        pass
+
+    @abstractmethod
+    def load(self):
+        pass
+
+    @abstractmethod
+    def add(self):
+        pass
+
+    @abstractmethod
+    def grade(self, id_: int):
+        pass
+
+    @abstractmethod
+    def update(self, id_: int):
+        pass
+
+    @abstractmethod
+    def delete(self, id_: int):
+        pass
+
+    def daily_average(self, date: datetime.date):
+        """Returns None if storage has no dates for marks"""
+        return None
+
+    def close(self):
+        pass
+
+
+class JsonListStorage(JournalStorage):
+    """hw03/journal.py, hw04/journal.py: list of students in memory, saved to JSON on quit"""
+    persistent = False
+
+    def __init__(self, relative_path: str):
+        self.name = relative_path
+        self.journal = import_journal(relative_path)
+
+    def prepare(self, directory, number_of_students):
+        self.file_path = os.path.join(directory, 'students.json')
+        with open(self.file_path, 'w') as f:
+            json.dump([{'id': key, 'name': student['name'], 'marks': [mark for _, mark in student['marks']],
+                        'info': student['info']} for key, student in generate_students(number_of_students)], f)
+
+    def load(self):
+        self.journal.storage = self.journal.read_storage_file(self.file_path)
+        self.journal.last_id = None
+
+    def _find(self, id_):
+        for index, student in enumerate(self.journal.storage):
+            if student['id'] == id_:
+                return index, student
+
+    def add(self):
+        self.journal.add_student('New Student', [5], '')
+
+    def grade(self, id_):
+        self.journal.add_mark(self._find(id_)[1], 7)
+
+    def update(self, id_):
+        self.journal.update_student(self._find(id_)[1], name='Updated Student')
+
+    def delete(self, id_):
+        self.journal.remove_student(self._find(id_)[0])
+
+
+class JsonDictStorage(JournalStorage):
+    """hw03/journal_optimized.py: dict of students by id in memory, saved to JSON on quit"""
+    persistent = False
+
+    def __init__(self, relative_path: str):
+        self.name = relative_path
+        self.journal = import_journal(relative_path)
+
+    def prepare(self, directory, number_of_students):
+        self.file_path = os.path.join(directory, 'students_optimized.json')
+        with open(self.file_path, 'w') as f:
+            json.dump({str(key): {'name': student['name'], 'marks': [mark for _, mark in student['marks']],
+                                  'info': student['info']} for key, student in generate_students(number_of_students)}, f)
+
+    def load(self):
+        self.journal.storage = self.journal.read_storage_file(self.file_path)
+        self.journal.last_id = None
+
+    def add(self):
+        self.journal.add_student('New Student', [5], '')
+
+    def grade(self, id_):
+        self.journal.add_mark(self.journal.storage[str(id_)], 7)
+
+    def update(self, id_):
+        self.journal.update_student(self.journal.storage[str(id_)], name='Updated Student')
+
+    def delete(self, id_):
+        self.journal.remove_student(str(id_))
+
+
+class CsvRepositoryStorage(JournalStorage):
+    """hw04/journal_optimized.py: Repository which rewrites CSV file on every change"""
+    name = 'hw04/journal_optimized.py'
+
+    def __init__(self):
+        self.journal = import_journal(self.name)
+
+    def prepare(self, directory, number_of_students):
+        self.file_path = os.path.join(directory, 'students.csv')
+        with open(self.file_path, 'w') as f:
+            f.write('id,name,info,marks\n')
+            for key, student in generate_students(number_of_students):
+                f.write(f'{key},{student["name"]},{student["info"]},"{",".join(str(mark) for _, mark in student["marks"])}"\n')
+
+    def load(self):
+        self.service = self.journal.StudentService(self.journal.Repository(self.file_path))
+
+    def add(self):
+        self.service.add_student('New Student', [5], '')
+
+    def grade(self, id_):
+        self.service.add_mark(id_, 7)
+
+    def update(self, id_):
+        self.service.update_student(id_, name='Updated Student')
+
+    def delete(self, id_):
+        self.service.remove_student(id_)
+
+
+class DatedRepositoryStorage(JournalStorage):
+    """hw08/journal.py: repositories with dated marks and marks index for daily average"""
+
+    def __init__(self, repository_class_name: str, file_name: str):
+        self.journal = import_journal('hw08/journal.py')
+        self.repository_class = getattr(self.journal, repository_class_name)
+        self.name = f'hw08/journal.py:{repository_class_name}'
+        self.file_name = file_name
+
+    def prepare(self, directory, number_of_students):
+        self.file_path = os.path.join(directory, self.file_name)
+        if self.file_path.endswith('.bin'):
+            repository = self.repository_class(self.file_path)
+            repository.add_students([student for _, student in generate_students(number_of_students)])
+            repository._write_storage()
+        else:
+            self.journal.write_students_csv(self.file_path, generate_students(number_of_students))
+
+    def load(self):
+        self.service = self.journal.StudentService(self.repository_class(self.file_path))
+
+    def add(self):
+        self.service.add_student('New Student', [(datetime.date.today(), 5)], '')
+
+    def grade(self, id_):
+        self.service.add_mark(id_, 7, datetime.date.today())
+
+    def update(self, id_):
+        self.service.update_student(id_, name='Updated Student')
+
+    def delete(self, id_):
+        self.service.remove_student(id_)
+
+    def daily_average(self, date):
+        return self.service.daily_average(date)
+
+    def close(self):
+        repository = self.service.repository
+        if getattr(repository, 'log', None):
+            repository.log.close()
+
+
+def create_storages():
+    return [JsonListStorage('hw03/journal.py'),
+            JsonDictStorage('hw03/journal_optimized.py'),
+            JsonListStorage('hw04/journal.py'),
+            CsvRepositoryStorage(),
+            DatedRepositoryStorage('Repository', 'students.csv'),
+            DatedRepositoryStorage('BinaryRepository', 'students.bin')]
+
+
+# ######################################################################################################################
+# Runner
+# ######################################################################################################################
+def measure(func, args_list):
+    """Returns average duration of func call in seconds over all args"""
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) / len(args_list)
+
+
+def benchmark_storage(storage: JournalStorage, number_of_students: int, ops: int):
+    """Returns {operation: seconds per operation} for storage of number_of_students"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        storage.prepare(directory, number_of_students)
+
+        start = time.perf_counter()
+        storage.load()
+        results['load'] = time.perf_counter() - start
+
+        ids = random.sample(range(1, number_of_students + 1), min(ops * 3, number_of_students))
+        grade_ids, update_ids, delete_ids = ids[0::3], ids[1::3], ids[2::3]
+        results['add'] = measure(storage.add, [()] * ops)
+        results['grade'] = measure(storage.grade, [(id_,) for id_ in grade_ids])
+        results['update'] = measure(storage.update, [(id_,) for id_ in update_ids])
+        results['delete'] = measure(storage.delete, [(id_,) for id_ in delete_ids])
+
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        if storage.daily_average(yesterday) is not None:
+            results['daily_average'] = measure(storage.daily_average, [(yesterday,)] * ops)
+        storage.close()
+    return results
+
+
+def run(sizes, ops):
+    records = []
+    for number_of_students in sizes:
+        for storage in create_storages():
+            results = benchmark_storage(storage, number_of_students, ops)
+            for operation, seconds in results.items():
+                records.append({'storage': storage.name,
+                                'persistent': storage.persistent,
+                                'students': number_of_students,
+                                'operation': operation,
+                                'seconds_per_op': seconds})
+            print(f"{storage.name:<40}{number_of_students:<12_}" +
+                  ''.join(f"{results[operation]:<15.6f}" if operation in results else f"{'-':<15}" for operation in OPERATIONS))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of students in storage')
+    parser.add_argument('--ops', type=int, default=10, help='number of timed calls of every operation')
+    parser.add_argument('--output', default='benchmark_results.json', help='file to save results in JSON')
+    args = parser.parse_args()
+
+    print(f"{'Storage':<40}{'Students':<12}" + ''.join(f"{operation + ', s':<15}" for operation in OPERATIONS))
+    records = run(args.sizes, args.ops)
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'ops': args.ops,
+                   'results': records}, f, indent=4)
+    print(f"\nResults are saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import json
 import sys
 
 storage: list[dict] = []  # global variable to keep students list
+last_id: int | None = None  # the biggest id assigned to student
 
 
 STUDENT_MANAGEMENT_COMMANDS = ('add', 'show all', 'show')
@@ -21,11 +22,12 @@ def save_storage_file(file_path):
 
 
 def get_next_id():
-    """Returns id to assign for the next student"""
-    if len(storage) == 0:
-        return 1
-    else:
-        return max([student['id'] for student in storage]) + 1
+    """Returns id to assign for the next student. Max id is calculated once, so ids of deleted students are not reused"""
+    global last_id
+    if last_id is None:
+        last_id = max((student['id'] for student in storage), default=0)
+    last_id += 1
+    return last_id
 
 
 def get_string_of_marks(student):
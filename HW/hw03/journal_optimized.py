@@ -3,6 +3,7 @@ import operator
 import sys
 
 storage: dict[str, dict] = {}  # global variable to keep students list
+last_id: int | None = None  # the biggest id assigned to student
 
 
 STUDENT_MANAGEMENT_COMMANDS = ('add', 'show all', 'show', 'remove', 'grade', 'update')
@@ -26,11 +27,12 @@ def save_storage_file(file_path: str):
 
 
 def get_next_id():
-    """Returns id to assign for the next student"""
-    if len(storage) == 0:
-        return "1"
-    else:
-        return str(max([int(key) for key in storage.keys()]) + 1)
+    """Returns id to assign for the next student. Max id is calculated once, so ids of deleted students are not reused"""
+    global last_id
+    if last_id is None:
+        last_id = max((int(key) for key in storage.keys()), default=0)
+    last_id += 1
+    return str(last_id)
 
 
 def get_string_of_marks(student: dict):
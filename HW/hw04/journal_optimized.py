@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 import csv
+import os
 from pathlib import Path
 import sys
 
@@ -29,6 +30,10 @@ class AbstractRepository(ABC):
     def add_student(self, student: dict):
         pass
 
+    @abstractmethod
+    def add_students(self, students: list[dict]):
+        pass
+
     @abstractmethod
     def get_all_students(self):
         pass
@@ -54,23 +59,66 @@ class Repository(AbstractRepository):
 
     def __init__(self, file_path):
         self.file_path = file_path
+        self.sequence_path = f'{file_path}.seq'
         self.students = {}
+        self.last_id = 0  # the biggest id ever assigned, so ids of deleted students are not reused
+        self._fingerprint = None
         self._read_storage()
 
     def get_next_id(self):
         """Returns id to assign for the next student"""
-        if len(self.students) == 0:
-            return 1
-        else:
-            return max([int(key) for key in self.students.keys()]) + 1
+        return self.last_id + 1
+
+    def _read_sequence(self):
+        """Returns last assigned id saved next to the storage file, 0 if it is missing or unreadable,
+        then the max id of storage is used"""
+        try:
+            with open(self.sequence_path) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_sequence(self):
+        tmp_path = f'{self.sequence_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(self.last_id))
+        os.replace(tmp_path, self.sequence_path)
+
+    def _storage_fingerprint(self):
+        """Returns inode, size and modification time of storage file to detect changes made outside"""
+        stat = os.stat(self.file_path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _refresh_storage(self):
+        """Re-reads storage only if file was changed not by this repository"""
+        if self._storage_fingerprint() != self._fingerprint:
+            self._read_storage()
 
     def _read_storage(self):
+        self._fingerprint = self._storage_fingerprint()
+        self.students = {}
+        self.last_id = self._read_sequence()
         with open(self.file_path, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
-                self.students[int(row['id'])] = {'name': row['name'],
-                                                 'info': row['info'],
-                                                 'marks': [int(mark) for mark in row['marks'].split(',') if mark]}
+                key = int(row['id'])
+                self.last_id = max(self.last_id, key)
+                self.students[key] = {'name': row['name'],
+                                      'info': row['info'],
+                                      'marks': [int(mark) for mark in row['marks'].split(',') if mark]}
+
+    def _append_students(self, keyed_students):
+        """Appends (id, student) pairs to the storage file, header is written first if the file is empty"""
+        with open(self.file_path, 'a', newline='') as csvfile:
+            fieldnames = ['id', 'name', 'info', 'marks']
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            if csvfile.tell() == 0:
+                writer.writeheader()
+            for key, student in keyed_students:
+                writer.writerow({'id': key,
+                                 'name': student['name'],
+                                 'info': student['info'],
+                                 'marks': ','.join([str(mark) for mark in student['marks']])})
 
     def _write_storage(self):
         with open(self.file_path, 'w', newline='') as csvfile:
@@ -83,24 +131,31 @@ class Repository(AbstractRepository):
                                  'name': student['name'],
                                  'info': student['info'],
                                  'marks': ','.join(str(mark) for mark in student['marks'])})
+        self._fingerprint = self._storage_fingerprint()
 
     def add_student(self, student: dict):
         key = self.get_next_id()
         self.students[key] = student
-        with open(self.file_path, 'a', newline='') as csvfile:
-            fieldnames = ['id', 'name', 'info', 'marks']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerow({'id': key,
-                             'name': student['name'],
-                             'info': student['info'],
-                             'marks': ','.join([str(mark) for mark in student['marks']])})
+        self._append_students([(key, student)])
+        self._fingerprint = self._storage_fingerprint()
+        self.last_id = key
+        self._write_sequence()
+
+    def add_students(self, students: list[dict]):
+        """Adds many students with one append to the storage file"""
+        keyed_students = list(enumerate(students, self.get_next_id()))
+        self.students.update(keyed_students)
+        self._append_students(keyed_students)
+        self._fingerprint = self._storage_fingerprint()
+        self.last_id += len(students)
+        self._write_sequence()
 
     def get_all_students(self):
-        self._read_storage()
+        self._refresh_storage()
         return self.students
 
     def get_student(self, id_: int):
-        self._read_storage()
+        self._refresh_storage()
         return self.students[id_]
 
     def update_student(self, id_: int, data: dict):
@@ -160,6 +215,12 @@ class StudentService:
                    "info": details if details else ""}
         self.repository.add_student(student)
 
+    def add_students(self, students: list[dict]):
+        """Adds many students at once. Each student is dict with 'name', 'marks' and 'info' keys"""
+        self.repository.add_students([{"name": student["name"],
+                                       "marks": student["marks"] if student["marks"] else [],
+                                       "info": student["info"] if student["info"] else ""} for student in students])
+
     def get_students(self):
         return self.repository.get_all_students()
 
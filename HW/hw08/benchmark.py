@@ -0,0 +1,237 @@
+"""Benchmarks for Digital Journal App
+
+Run from HW/hw08 directory:
+    python benchmark.py
+"""
+import datetime
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from journal import BinaryRepository, Repository, calculate_average_mark_with_processes, write_students_csv
+
+SIZES = (10_000, 100_000, 1_000_000)
+MARKS_PER_STUDENT = 10
+
+
+def generate_students(number_of_students):
+    """Yields synthetic students, each has MARKS_PER_STUDENT marks for the last days"""
+    today = datetime.date.today()
+    for i in range(number_of_students):
+        yield {'name': f'Student {i + 1}',
+               'info': '',
+               'marks': [(today - datetime.timedelta(days=j), random.randint(1, 12)) for j in range(MARKS_PER_STUDENT)]}
+
+
+def measure(func, repeat):
+    """Returns average duration of one func call in seconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark_lookup(number_of_students):
+    """Compares get_student served from memory with re-reading storage on every lookup (previous behaviour)
+
+    Students    Cached lookup, s    Re-read lookup, s
+    10_000      0.0000097           0.2248
+    100_000     0.0000112           1.8958
+    1_000_000   0.0000123           23.3138
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'students.csv')
+        write_students_csv(file_path, enumerate(generate_students(number_of_students), 1))
+        repository = Repository(file_path)
+
+        def cached_lookup():
+            repository.get_student(random.randint(1, number_of_students))
+
+        def re_read_lookup():
+            repository._read_storage()
+            repository.get_student(random.randint(1, number_of_students))
+
+        cached = measure(cached_lookup, 1000)
+        re_read = measure(re_read_lookup, 3)
+        repository.log.close()
+    return cached, re_read
+
+
+def measure_load(repository_class, file_path):
+    """Returns time to open repository and memory in MB it takes (measured in separate run, as tracing is slow)"""
+    start = time.perf_counter()
+    repository = repository_class(file_path)
+    duration = time.perf_counter() - start
+    del repository
+
+    tracemalloc.start()
+    repository = repository_class(file_path)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return repository, duration, memory / 1024 / 1024
+
+
+def benchmark_load(number_of_students):
+    """Compares loading CSV storage with loading binary columnar storage
+
+    Students    CSV load, s    CSV memory, MB    Binary load, s    Binary memory, MB
+    10_000      0.1754         12.9              0.0015            0.8
+    100_000     1.4963         132.5             0.0145            10.7
+    1_000_000   18.6745        1316.7            0.2100            97.2
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'students.csv')
+        write_students_csv(csv_path, enumerate(generate_students(number_of_students), 1))
+        binary_path = os.path.join(tmp_dir, 'students.bin')
+        BinaryRepository(binary_path).add_students(list(generate_students(number_of_students)))
+
+        # binary storage goes first, as loading big CSV could push its files out of page cache
+        binary_repository, binary_load, binary_memory = measure_load(BinaryRepository, binary_path)
+        assert len(binary_repository) == number_of_students
+        csv_repository, csv_load, csv_memory = measure_load(Repository, csv_path)
+        assert len(csv_repository) == number_of_students
+        csv_repository.log.close()
+    return csv_load, csv_memory, binary_load, binary_memory
+
+
+def _sum_marks_for_day(days: np.ndarray, marks: np.ndarray, day: int):
+    """Returns number and sum of marks given on the day"""
+    selected = marks[days == day]
+    return len(selected), int(selected.sum(dtype=np.int64))
+
+
+def _sum_shared_marks_for_day(days_name: str, marks_name: str, length: int, start: int, stop: int, day: int):
+    """Runs in pool process: attaches to shared columns and sums marks of the shard"""
+    days_memory = shared_memory.SharedMemory(name=days_name)
+    marks_memory = shared_memory.SharedMemory(name=marks_name)
+    try:
+        days = np.ndarray((length,), dtype=np.uint32, buffer=days_memory.buf)
+        marks = np.ndarray((length,), dtype=np.uint8, buffer=marks_memory.buf)
+        result = _sum_marks_for_day(days[start:stop], marks[start:stop], day)
+        del days, marks  # views should be released before shared memory is closed
+        return result
+    finally:
+        days_memory.close()
+        marks_memory.close()
+
+
+class DailyAverageEngine:
+    """Calculates average mark for a day over columns of all marks (day ordinals and marks)
+    with vectorized mask and sum instead of looping over students in Python.
+
+    If processes > 1, columns are copied into shared memory once per load and shards are summed by persistent
+    process pool, so nothing is pickled except shard bounds.
+    Reports of journal.py are served by MarksIndex, the engine is kept here for comparison.
+    """
+
+    def __init__(self, processes: int = 1):
+        self.processes = processes
+        self.pool = ProcessPoolExecutor(processes) if processes > 1 else None
+        self.days = np.empty(0, dtype=np.uint32)
+        self.marks = np.empty(0, dtype=np.uint8)
+        self.shared = None
+
+    def load(self, days: np.ndarray, marks: np.ndarray):
+        self.days = days
+        self.marks = marks
+        if self.pool:
+            self._release_shared()
+            self.shared = []
+            for column in (days, marks):
+                memory = shared_memory.SharedMemory(create=True, size=max(column.nbytes, 1))
+                np.ndarray(column.shape, dtype=column.dtype, buffer=memory.buf)[:] = column
+                self.shared.append(memory)
+
+    def average(self, search_date: datetime.date) -> float | None:
+        day = search_date.toordinal()
+        if self.pool and len(self.days):
+            length = len(self.days)
+            shard = length // self.processes + 1
+            days_memory, marks_memory = self.shared
+            futures = [self.pool.submit(_sum_shared_marks_for_day, days_memory.name, marks_memory.name,
+                                        length, start, min(start + shard, length), day)
+                       for start in range(0, length, shard)]
+            results = [future.result() for future in futures]
+        else:
+            results = [_sum_marks_for_day(self.days, self.marks, day)]
+
+        number_of_marks = sum(count for count, _ in results)
+        sum_of_marks = sum(total for _, total in results)
+        return sum_of_marks / number_of_marks if number_of_marks else None
+
+    def _release_shared(self):
+        for memory in self.shared or ():
+            memory.close()
+            memory.unlink()
+        self.shared = None
+
+    def close(self):
+        self._release_shared()
+        if self.pool:
+            self.pool.shutdown()
+
+
+def benchmark_daily_average(number_of_students):
+    """Compares daily average calculated by freshly started processes over students dict
+    with vectorized calculation over marks columns (in the main process and in pool of 2 processes)
+
+    Students    Processes, s    Columns build, s    Vectorized, s    Pool of 2, s
+    10_000      0.0282          0.0176              0.00022          0.00185
+    100_000     0.2410          0.1793              0.00188          0.00420
+    1_000_000   2.6566          2.2499              0.02042          0.02848
+
+    Measured on 1 CPU, so pool could only add overhead here.
+    """
+    students = dict(enumerate(generate_students(number_of_students), 1))
+    search_date = datetime.date.today() - datetime.timedelta(days=1)
+
+    start = time.perf_counter()
+    expected = calculate_average_mark_with_processes(students, search_date)
+    processes = time.perf_counter() - start
+
+    start = time.perf_counter()
+    days = np.fromiter((date_mark[0].toordinal() for student in students.values() for date_mark in student['marks']),
+                       dtype=np.uint32)
+    marks = np.fromiter((date_mark[1] for student in students.values() for date_mark in student['marks']),
+                        dtype=np.uint8)
+    columns_build = time.perf_counter() - start
+
+    engine = DailyAverageEngine()
+    engine.load(days, marks)
+    vectorized = measure(lambda: engine.average(search_date), 10)
+    assert abs(engine.average(search_date) - expected) < 1e-9
+
+    pool_engine = DailyAverageEngine(processes=2)
+    pool_engine.load(days, marks)
+    pool_engine.average(search_date)  # warm up pool processes
+    pool = measure(lambda: pool_engine.average(search_date), 10)
+    assert abs(pool_engine.average(search_date) - expected) < 1e-9
+    pool_engine.close()
+    return processes, columns_build, vectorized, pool
+
+
+def main():
+    print(f"{'Students':<12}{'Cached lookup, s':<20}{'Re-read lookup, s':<20}")
+    for number_of_students in SIZES:
+        cached, re_read = benchmark_lookup(number_of_students)
+        print(f"{number_of_students:<12_}{cached:<20.7f}{re_read:<20.4f}")
+
+    print(f"\n{'Students':<12}{'CSV load, s':<15}{'CSV memory, MB':<18}{'Binary load, s':<18}{'Binary memory, MB':<18}")
+    for number_of_students in SIZES:
+        csv_load, csv_memory, binary_load, binary_memory = benchmark_load(number_of_students)
+        print(f"{number_of_students:<12_}{csv_load:<15.4f}{csv_memory:<18.1f}{binary_load:<18.4f}{binary_memory:<18.1f}")
+
+    print(f"\n{'Students':<12}{'Processes, s':<16}{'Columns build, s':<20}{'Vectorized, s':<17}{'Pool of 2, s':<16}")
+    for number_of_students in SIZES:
+        processes, columns_build, vectorized, pool = benchmark_daily_average(number_of_students)
+        print(f"{number_of_students:<12_}{processes:<16.4f}{columns_build:<20.4f}{vectorized:<17.5f}{pool:<16.5f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,100 @@
 import csv
 import datetime
+import heapq
 import json
+import mmap
 import os.path
 import sys
 import time
 from abc import ABC, abstractmethod
+from array import array
+from collections import Counter, defaultdict
+from functools import partial
+from itertools import compress
 from pathlib import Path
 from multiprocessing import Process, Value, cpu_count
-from threading import Thread, Lock
+from threading import Condition, Thread, Lock
 
+import numpy as np
 from colorama import Fore, init, Style
 
-from mail_server import Message, SMTPService
+from mail_server import MailQueue, Message
 
-REPORT_PERIOD_CHECK = 5  # time in seconds to check if periodic report should be sent
+REPORT_RETRY_PERIOD = 5  # time in seconds to retry periodic report which couldn't be sent
 EVERY_MONTH_PERIOD = 20 # 30 * 24 * 3600
 EVERY_DAY_PERIOD = 10 # 24 * 3600
 STATE_FILE = 'state.json'  # file to save timestamps for sending reports
+CSV_FIELDNAMES = ['id', 'name', 'info', 'marks']
+CSV_CHUNK_SIZE = 10_000  # number of students read from CSV file at once
+LOG_COMPACTION_THRESHOLD = 1024 * 1024  # size of students log in bytes after which it is compacted into storage file
 STUDENT_MANAGEMENT_COMMANDS = ('add', 'show all', 'show', 'remove', 'grade', 'update')
 AUXILIARY_COMMANDS = ('help', 'quit', 'email')
 COMMAND_LIST = ', '.join((*STUDENT_MANAGEMENT_COMMANDS, *AUXILIARY_COMMANDS))
 
 RECIPIENT_EMAIL = None
 SENDER_EMAIL = "reporting@digital.journal"
+MAIL_QUEUE: MailQueue | None = None
 STATE_LOCK = Lock()
+STATE: dict | None = None  # cached content of state file
 
 # ######################################################################################################################
 # Infrastructure
 # ######################################################################################################################
 
+def parse_marks(raw_marks: str):
+    """Parses marks from 'YYYY-MM-DD|mark,...' string"""
+    marks = []
+    for date_mark in raw_marks.split(','):
+        if date_mark:
+            date, mark = date_mark.split('|')
+            marks.append((datetime.date.fromisoformat(date), int(mark)))
+    return marks
+
+def format_marks(marks: list[tuple[datetime.date, int]]):
+    """Formats marks to 'YYYY-MM-DD|mark,...' string"""
+    return ','.join(f"{date_mark[0].isoformat()}|{date_mark[1]}" for date_mark in marks)
+
+def read_students_csv(file_path, chunk_size: int = CSV_CHUNK_SIZE, progress=None):
+    """Yields lists of (id, student) pairs of chunk_size length from CSV file, so only one chunk is kept in memory.
+    Optional progress callback gets number of rows read so far after each chunk"""
+    with open(file_path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        chunk = []
+        rows = 0
+        for row in reader:
+            chunk.append((int(row['id']), {'name': row['name'], 'info': row['info'], 'marks': parse_marks(row['marks'])}))
+            if len(chunk) == chunk_size:
+                rows += len(chunk)
+                yield chunk
+                chunk = []
+                if progress:
+                    progress(rows)
+        if chunk:
+            yield chunk
+            if progress:
+                progress(rows + len(chunk))
+
+def write_students_csv(file_path, students, progress=None, progress_step: int = CSV_CHUNK_SIZE):
+    """Writes (id, student) pairs from any iterable (e.g. generator) to CSV file row by row and syncs it to disk.
+    Optional progress callback gets number of rows written so far after every progress_step rows"""
+    with open(file_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
+        writer.writeheader()
+        rows = 0
+        for key, student in students:
+            writer.writerow({'id': key,
+                             'name': student['name'],
+                             'info': student['info'],
+                             'marks': format_marks(student['marks'])})
+            rows += 1
+            if progress and rows % progress_step == 0:
+                progress(rows)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    if progress and rows % progress_step:
+        progress(rows)
+
+
 class AbstractRepository(ABC):
 
     @abstractmethod
@@ -43,6 +109,10 @@ class AbstractRepository(ABC):
     def add_student(self, student: dict):
         pass
 
+    @abstractmethod
+    def add_students(self, students: list[dict]):
+        pass
+
     @abstractmethod
     def get_all_students(self):
         pass
@@ -63,79 +133,524 @@ class AbstractRepository(ABC):
     def add_mark(self, id_: int, mark: int, date: datetime.date):
         pass
 
+    @abstractmethod
+    def get_marks_columns(self) -> tuple[np.ndarray, np.ndarray]:
+        """Returns marks of all students as two columns: day ordinals (uint32) and marks (uint8)"""
+        pass
+
+    def refresh(self) -> int:
+        """Re-reads storage if it was changed outside and returns version of the data, which is changed on every
+        re-read, so data derived from the repository knows when to be rebuilt"""
+        return 0
+
 
 class Repository(AbstractRepository):
+    """Keeps students in CSV snapshot file and appends every change to the log file next to it.
+
+    Log is replayed over the snapshot on startup, so adding a mark costs one appended line instead of
+    rewriting the whole file. When log grows above LOG_COMPACTION_THRESHOLD it is compacted into new snapshot
+    in background thread.
+    """
 
     def __init__(self, file_path):
         self.file_path = file_path
+        self.log_path = f'{file_path}.log'
+        self.compacting_log_path = f'{file_path}.log.compacting'
+        self.sequence_path = f'{file_path}.seq'
         self.students = {}
+        self.last_id = 0  # the biggest id ever assigned, so ids of deleted students are not reused
+        self.lock = Lock()
+        self._compaction_thread = None
+        self.log = None
+        self._fingerprint = None
+        self._version = 0
         self._read_storage()
+        # records left after previous run (also the ones from interrupted compaction) are moved into snapshot
+        if os.path.exists(self.compacting_log_path) or self._log_size(self.log_path) > 0:
+            self._write_storage()
+        else:
+            self.log = open(self.log_path, 'a')
+            self._fingerprint = self._storage_fingerprint()
 
     def get_next_id(self):
         """Returns id to assign for the next student"""
-        if len(self.students) == 0:
-            return 1
-        else:
-            return max([int(key) for key in self.students.keys()]) + 1
+        return self.last_id + 1
+
+    def _read_sequence(self):
+        """Returns last assigned id saved together with the latest snapshot"""
+        try:
+            with open(self.sequence_path) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _write_sequence(self, last_id: int):
+        tmp_path = f'{self.sequence_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(last_id))
+        os.replace(tmp_path, self.sequence_path)
+
+    @staticmethod
+    def _log_size(log_path):
+        return os.path.getsize(log_path) if os.path.exists(log_path) else 0
+
+    def _storage_fingerprint(self):
+        """Returns inode, size and modification time of storage files to detect changes made outside"""
+        fingerprint = []
+        for path in (self.file_path, self.compacting_log_path, self.log_path):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                fingerprint.append(None)
+            else:
+                fingerprint.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return tuple(fingerprint)
+
+    def _refresh_storage(self):
+        """Re-reads storage only if files were changed not by this repository"""
+        with self.lock:
+            if self._storage_fingerprint() != self._fingerprint:
+                self._load_storage()
 
     def _read_storage(self):
-        with open(self.file_path, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.students[int(row['id'])] = {'name': row['name'],
-                                                 'info': row['info'],
-                                                 'marks': [(datetime.date.fromisoformat(date_mark.split("|")[0]),
-                                                            int(date_mark.split("|")[1]))
-                                                           for date_mark in row['marks'].split(',') if date_mark]}
+        """Reads snapshot and replays log records over it"""
+        with self.lock:
+            self._load_storage()
+
+    def _load_storage(self):
+        """Should be called under the lock"""
+        self._version += 1
+        self._fingerprint = self._storage_fingerprint()
+        self.students = {}
+        self.last_id = self._read_sequence()
+        for chunk in read_students_csv(self.file_path):
+            self.students.update(chunk)
+            self.last_id = max(self.last_id, *(key for key, _ in chunk))
+        self._replay_log(self.compacting_log_path)
+        self._replay_log(self.log_path)
+
+    def _replay_log(self, log_path):
+        if not os.path.exists(log_path):
+            return
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # last record could be written partially if application crashed
+                    break
+                self._apply_log_record(record)
+
+    def _apply_log_record(self, record: dict):
+        """Applies log record to students. Records could be replayed over snapshot that already contains them,
+        so applying them once more should give the same result. Snapshot could also miss the student of the record
+        if the student was deleted later, then the record is skipped"""
+        match record['op']:
+            case 'add':
+                self.last_id = max(self.last_id, record['id'])
+                self.students[record['id']] = {'name': record['name'],
+                                               'info': record['info'],
+                                               'marks': [(datetime.date.fromisoformat(date), mark)
+                                                         for date, mark in record['marks']]}
+            case 'update':
+                if record['id'] in self.students:
+                    self.students[record['id']].update(record['data'])
+            case 'delete':
+                self.students.pop(record['id'], None)
+            case 'mark':
+                if record['id'] not in self.students:
+                    return
+                marks = self.students[record['id']]['marks']
+                if len(marks) == record['position']:  # otherwise mark is already in snapshot
+                    marks.append((datetime.date.fromisoformat(record['date']), record['mark']))
+
+    def _append_log(self, *records: dict):
+        """Appends records to the log. Should be called under the lock"""
+        self.log.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self._fingerprint = self._storage_fingerprint()
+
+    def _write_snapshot(self, students: dict):
+        """Writes students into temporary file, which replaces snapshot later, so snapshot is never half-written"""
+        tmp_path = f'{self.file_path}.tmp'
+        write_students_csv(tmp_path, students.items())
+        return tmp_path
+
+    def _replace_snapshot(self, tmp_path, last_id: int):
+        """Should be called under the lock, so storage is not re-read between replacing the snapshot
+        and removing the log compacted into it"""
+        self._write_sequence(last_id)
+        os.replace(tmp_path, self.file_path)
 
     def _write_storage(self):
-        with open(self.file_path, 'w', newline='') as csvfile:
-            fieldnames = ['id', 'name', 'info', 'marks']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            writer.writeheader()
-            for key, student in self.students.items():
-                writer.writerow({'id': key,
-                                 'name': student['name'],
-                                 'info': student['info'],
-                                 'marks': ','.join(f"{date_mark[0].strftime('%Y-%m-%d')}|{date_mark[1]}" for date_mark in student['marks'])})
+        """Writes all students into snapshot and clears the log"""
+        with self.lock:
+            if self.log:
+                self.log.close()
+            self._replace_snapshot(self._write_snapshot(self.students), self.last_id)
+            if os.path.exists(self.compacting_log_path):
+                os.remove(self.compacting_log_path)
+            self.log = open(self.log_path, 'w')
+            self._fingerprint = self._storage_fingerprint()
+
+    def _compact_if_needed(self):
+        """Starts log compaction in background if log is too big"""
+        with self.lock:
+            if self.log.tell() <= LOG_COMPACTION_THRESHOLD:
+                return
+            if self._compaction_thread and self._compaction_thread.is_alive():
+                return
+            if os.path.exists(self.compacting_log_path):  # previous compaction failed, its records can't be dropped
+                compact_now = True
+            else:
+                compact_now = False
+                # new records go to the new log while snapshot is written from the copy of students
+                self.log.close()
+                os.replace(self.log_path, self.compacting_log_path)
+                self.log = open(self.log_path, 'a')
+                self._fingerprint = self._storage_fingerprint()
+                students = {key: {**student, 'marks': list(student['marks'])} for key, student in self.students.items()}
+                last_id = self.last_id
+        if compact_now:
+            self._write_storage()
+        else:
+            self._compaction_thread = Thread(target=self._compact, args=(students, last_id), daemon=True)
+            self._compaction_thread.start()
+
+    def _compact(self, students: dict, last_id: int):
+        tmp_path = self._write_snapshot(students)
+        with self.lock:
+            self._replace_snapshot(tmp_path, last_id)
+            os.remove(self.compacting_log_path)
+            self._fingerprint = self._storage_fingerprint()
+
+    @staticmethod
+    def _add_record(key: int, student: dict):
+        return {'op': 'add',
+                'id': key,
+                'name': student['name'],
+                'info': student['info'],
+                'marks': [(date_mark[0].isoformat(), date_mark[1]) for date_mark in student['marks']]}
 
     def add_student(self, student: dict):
-        key = self.get_next_id()
-        self.students[key] = student
-        with open(self.file_path, 'a', newline='') as csvfile:
-            fieldnames = ['id', 'name', 'info', 'marks']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            if len(self.students) == 1:  # write headers if 1st student is added
-                writer.writeheader()
-            writer.writerow({'id': key,
-                             'name': student['name'],
-                             'info': student['info'],
-                             'marks': ','.join([f"{date_mark[0].strftime('%Y-%m-%d')}|{date_mark[1]}" for date_mark in student['marks']])})
+        with self.lock:
+            key = self.get_next_id()
+            self._append_log(self._add_record(key, student))
+            self.students[key] = student
+            self.last_id = key
+        self._compact_if_needed()
+        return key
+
+    def add_students(self, students: list[dict]):
+        """Adds many students with one write to the log"""
+        with self.lock:
+            first_key = self.get_next_id()
+            self._append_log(*(self._add_record(key, student) for key, student in enumerate(students, first_key)))
+            for key, student in enumerate(students, first_key):
+                self.students[key] = student
+            self.last_id += len(students)
+        self._compact_if_needed()
+        return list(range(first_key, first_key + len(students)))
+
+    def refresh(self):
+        self._refresh_storage()
+        return self._version
 
     def get_all_students(self):
-        self._read_storage()
+        self._refresh_storage()
         return self.students
 
     def get_student(self, id_: int):
-        self._read_storage()
+        self._refresh_storage()
         return self.students[id_]
 
     def update_student(self, id_: int, data: dict):
-        self.students[id_].update(data)
-        self._write_storage()
+        with self.lock:
+            student = self.students[id_]
+            self._append_log({'op': 'update', 'id': id_, 'data': data})
+            student.update(data)
+        self._compact_if_needed()
 
     def delete_student(self, id_: int):
-        del self.students[id_]
-        self._write_storage()
+        with self.lock:
+            if id_ not in self.students:
+                raise KeyError(id_)
+            self._append_log({'op': 'delete', 'id': id_})
+            del self.students[id_]
+        self._compact_if_needed()
 
     def add_mark(self, id_: int, mark: int, date: datetime.date):
-        self.students[id_]['marks'].append((date, mark))
-        self._write_storage()
+        with self.lock:
+            marks = self.students[id_]['marks']
+            self._append_log({'op': 'mark', 'id': id_, 'position': len(marks), 'date': date.isoformat(), 'mark': mark})
+            marks.append((date, mark))
+        self._compact_if_needed()
+
+    def get_marks_columns(self):
+        students = self.get_all_students()
+        with self.lock:
+            days = np.fromiter((date_mark[0].toordinal() for student in students.values() for date_mark in student['marks']),
+                               dtype=np.uint32)
+            marks = np.fromiter((date_mark[1] for student in students.values() for date_mark in student['marks']),
+                                dtype=np.uint8)
+        return days, marks
 
     def __len__(self):
         return len(self.students)
 
+class MappedColumn:
+    """Column of fixed-size numbers kept in memory-mapped file.
+
+    File is grown in big steps, so it is re-mapped rarely. Slices are returned as lists, so no views
+    of the mapping live outside and it can be closed on re-mapping.
+    """
+
+    def __init__(self, file_path, typecode):
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        self.map = None
+        self.view = None
+        self._remap()
+
+    def _remap(self, size=None):
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+            self.view = self.map = None
+        if size is not None:
+            os.ftruncate(self.fd, size)
+        size = os.fstat(self.fd).st_size
+        if size:
+            self.map = mmap.mmap(self.fd, size)
+            self.view = memoryview(self.map).cast(self.typecode)
+
+    def reserve(self, length):
+        """Grows file to keep at least length items"""
+        if length > len(self):
+            self._remap(max(length, 2 * len(self), 1024) * self.itemsize)
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def to_numpy(self, stop):
+        """Returns copy of the first items as numpy array"""
+        if self.view is None:
+            return np.empty(0, dtype=self.typecode)
+        with self.view[:stop] as part:
+            return np.array(part)
+
+    def __len__(self):
+        return len(self.view) if self.view is not None else 0
+
+    def __getitem__(self, key):
+        if self.view is None:  # nothing is mapped in empty file
+            if isinstance(key, slice):
+                return []
+            raise IndexError(key)
+        if isinstance(key, slice):
+            return self.view[key].tolist()
+        return self.view[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            value = array(self.typecode, value)
+        self.view[key] = value
+
+
+class BinaryRepository(AbstractRepository):
+    """Keeps marks as packed columns in memory-mapped files: day ordinals (uint32) in <path>.days and marks (uint8)
+    in <path>.marks. Names and info are kept in <path>.text.
+
+    Index file <path> has record per student (id, marks offset, marks count, marks capacity, text offset, text length),
+    the first record is a header (number of records, used marks length, last assigned id). Each student owns continuous
+    part of the columns. When it is full, marks are moved to the end of columns with doubled capacity.
+    Loading reads only the index, marks are read from the page cache when they are needed.
+    """
+
+    INDEX_FIELDS = 6
+    DELETED = 0xFFFFFFFF  # text length of deleted student
+    MIN_MARKS_CAPACITY = 4
+    MAX_MARK = 0xFF  # marks are kept as uint8
+    SEPARATOR = '\x1f'  # separates name and info in text file
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = Lock()
+        self.index = MappedColumn(file_path, 'I')
+        self.days = MappedColumn(f'{file_path}.days', 'I')
+        self.marks = MappedColumn(f'{file_path}.marks', 'B')
+        self.text = open(f'{file_path}.text', 'a+b')
+        self.slots = {}  # student id -> number of record in index
+        self.number_of_records = 0
+        self.marks_used = 0
+        self.last_id = 0
+        self._read_storage()
+
+    def get_next_id(self):
+        """Returns id to assign for the next student"""
+        return self.last_id + 1
+
+    def _read_storage(self):
+        with self.lock:
+            self.index.reserve(self.INDEX_FIELDS)
+            self.number_of_records, self.marks_used, self.last_id = self.index[0:3]
+            end = (self.number_of_records + 1) * self.INDEX_FIELDS
+            ids = self.index[self.INDEX_FIELDS:end:self.INDEX_FIELDS]
+            text_lengths = self.index[self.INDEX_FIELDS + 5:end:self.INDEX_FIELDS]
+            self.slots = dict(zip(ids, range(1, len(ids) + 1)))
+            for id_ in compress(ids, map(self.DELETED.__eq__, text_lengths)):
+                del self.slots[id_]
+
+    def _write_storage(self):
+        """Flushes memory-mapped files to disk"""
+        with self.lock:
+            self.index.flush()
+            self.days.flush()
+            self.marks.flush()
+            self.text.flush()
+            os.fsync(self.text.fileno())
+
+    def _write_header(self):
+        self.index[0:3] = (self.number_of_records, self.marks_used, self.last_id)
+
+    def _allocate_marks(self, capacity):
+        """Returns offset of new part of columns with given capacity"""
+        offset = self.marks_used
+        self.marks_used += capacity
+        self.days.reserve(self.marks_used)
+        self.marks.reserve(self.marks_used)
+        return offset
+
+    def _write_text(self, name, info):
+        data = f'{name}{self.SEPARATOR}{info}'.encode()
+        self.text.seek(0, os.SEEK_END)
+        offset = self.text.tell()
+        self.text.write(data)
+        self.text.flush()
+        return offset, len(data)
+
+    def _read_text(self, offset, length):
+        self.text.seek(offset)
+        name, info = self.text.read(length).decode().split(self.SEPARATOR)
+        return name, info
+
+    def _check_marks(self, marks):
+        """Raises ValueError for mark which doesn't fit into marks column, before anything is written"""
+        for mark in marks:
+            if not 0 <= mark <= self.MAX_MARK:
+                raise ValueError(f"Mark {mark} is out of range 0-{self.MAX_MARK} supported by binary storage")
+
+    def _add_student(self, student: dict):
+        """Adds student. Should be called under the lock"""
+        key = self.get_next_id()
+        marks = student['marks']
+        capacity = max(len(marks), self.MIN_MARKS_CAPACITY)
+        offset = self._allocate_marks(capacity)
+        self.days[offset:offset + len(marks)] = [date_mark[0].toordinal() for date_mark in marks]
+        self.marks[offset:offset + len(marks)] = [date_mark[1] for date_mark in marks]
+        text_offset, text_length = self._write_text(student['name'], student['info'])
+
+        record = self.number_of_records + 1
+        self.index.reserve((record + 1) * self.INDEX_FIELDS)
+        start = record * self.INDEX_FIELDS
+        self.index[start:start + self.INDEX_FIELDS] = (key, offset, len(marks), capacity, text_offset, text_length)
+        self.number_of_records = record
+        self.last_id = key
+        self._write_header()  # student is visible after restart only when header is updated
+        self.slots[key] = record
+        return key
+
+    def add_student(self, student: dict):
+        self._check_marks(date_mark[1] for date_mark in student['marks'])
+        with self.lock:
+            return self._add_student(student)
+
+    def add_students(self, students: list[dict]):
+        # all students are checked first, so none of them is added if one has invalid mark
+        self._check_marks(date_mark[1] for student in students for date_mark in student['marks'])
+        with self.lock:
+            return [self._add_student(student) for student in students]
+
+    def _get_student(self, record):
+        start = record * self.INDEX_FIELDS
+        _, offset, count, _, text_offset, text_length = self.index[start:start + self.INDEX_FIELDS]
+        name, info = self._read_text(text_offset, text_length)
+        return {'name': name,
+                'info': info,
+                'marks': [(datetime.date.fromordinal(day), mark)
+                          for day, mark in zip(self.days[offset:offset + count], self.marks[offset:offset + count])]}
+
+    def get_all_students(self):
+        """Reads each file once instead of reading every student separately"""
+        with self.lock:
+            index = self.index[:(self.number_of_records + 1) * self.INDEX_FIELDS]
+            days = self.days[:self.marks_used]
+            marks = self.marks[:self.marks_used]
+            self.text.seek(0)
+            text = self.text.read()
+        students = {}
+        for key, record in self.slots.items():
+            start = record * self.INDEX_FIELDS
+            _, offset, count, _, text_offset, text_length = index[start:start + self.INDEX_FIELDS]
+            name, info = text[text_offset:text_offset + text_length].decode().split(self.SEPARATOR)
+            students[key] = {'name': name,
+                             'info': info,
+                             'marks': [(datetime.date.fromordinal(day), mark)
+                                       for day, mark in zip(days[offset:offset + count], marks[offset:offset + count])]}
+        return students
+
+    def get_student(self, id_: int):
+        with self.lock:
+            return self._get_student(self.slots[id_])
+
+    def update_student(self, id_: int, data: dict):
+        with self.lock:
+            start = self.slots[id_] * self.INDEX_FIELDS
+            name, info = self._read_text(self.index[start + 4], self.index[start + 5])
+            self.index[start + 4:start + 6] = self._write_text(data.get('name', name), data.get('info', info))
+
+    def delete_student(self, id_: int):
+        with self.lock:
+            record = self.slots.pop(id_)
+            self.index[record * self.INDEX_FIELDS + 5] = self.DELETED
+
+    def add_mark(self, id_: int, mark: int, date: datetime.date):
+        self._check_marks([mark])
+        with self.lock:
+            start = self.slots[id_] * self.INDEX_FIELDS
+            _, offset, count, capacity = self.index[start:start + 4]
+            if count == capacity:
+                new_capacity = 2 * capacity
+                new_offset = self._allocate_marks(new_capacity)
+                self.days[new_offset:new_offset + count] = self.days[offset:offset + count]
+                self.marks[new_offset:new_offset + count] = self.marks[offset:offset + count]
+                self.index[start + 1] = new_offset
+                self.index[start + 3] = new_capacity
+                self._write_header()
+                offset = new_offset
+            self.days[offset + count] = date.toordinal()
+            self.marks[offset + count] = mark
+            self.index[start + 2] = count + 1
+
+    def get_marks_columns(self):
+        """Gathers marks of existing students. Columns also keep marks of deleted students and old copies
+        of moved marks, so they can't be returned as is"""
+        with self.lock:
+            records = self.index.to_numpy((self.number_of_records + 1) * self.INDEX_FIELDS)
+            records = records.reshape(-1, self.INDEX_FIELDS)[1:]
+            records = records[records[:, 5] != self.DELETED]
+            offsets = records[:, 1].astype(np.int64)
+            counts = records[:, 2].astype(np.int64)
+            # position of every mark: offset of its student + number of the mark inside the student
+            starts = np.cumsum(counts) - counts
+            positions = np.repeat(offsets - starts, counts) + np.arange(counts.sum())
+            return self.days.to_numpy(self.marks_used)[positions], self.marks.to_numpy(self.marks_used)[positions]
+
+    def __len__(self):
+        return len(self.slots)
+
 # ######################################################################################################################
 # Helpers
 # ######################################################################################################################
@@ -191,14 +706,148 @@ def split_dict_into_chunks(original_dict, chunks):
             yield new_dict
             new_dict = {}
 
+def calculate_average_mark_with_processes(students: dict, search_date: datetime.date):
+    """Calculates average mark for the date, splitting students between freshly started processes.
+    Previous implementation of daily report, it is kept for comparison in benchmark.py
+
+    Users                1000                   1000_000
+    One process         0.00040449993684887886  0.2397951000602916
+    CPU# processes      0.7411272999597713      9.727466400014237
+    """
+    processes = []
+    number_of_marks = []
+    sum_of_marks = []
+
+    for chunk in split_dict_into_chunks(students, cpu_count()):
+        number_of_marks_ret = Value('i')
+        number_of_marks.append(number_of_marks_ret)
+        sum_of_marks_ret = Value('i')
+        sum_of_marks.append(sum_of_marks_ret)
+
+        p = Process(target=_average_calc_helper, args=(chunk, search_date, number_of_marks_ret, sum_of_marks_ret))
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+
+    try:
+        return sum([sum_.value for sum_ in sum_of_marks]) / sum([num.value for num in number_of_marks])
+    except ZeroDivisionError:
+        return None
+
 def send_email(subject, message):
     message = Message(
         from_addr=SENDER_EMAIL,
         subject=subject,
         message=message,
     )
-    with SMTPService() as mailing:
-        mailing.send(from_=SENDER_EMAIL, to=RECIPIENT_EMAIL, message=message)
+    MAIL_QUEUE.put(from_=SENDER_EMAIL, to=RECIPIENT_EMAIL, message=message)
+
+class MarksIndex:
+    """Keeps number and sum of marks per day and per month, so statistics for a period don't scan marks of all students.
+
+    Statistics are built from marks columns of the repository with numpy by refresh, before any mark is changed
+    through the index, and again when the repository re-reads storage changed by another process. Between rebuilds
+    they are updated on every added or removed mark. Ids of students graded on the day are indexed only when
+    graded_students is called.
+    """
+
+    def __init__(self, repository: AbstractRepository):
+        self.lock = Lock()
+        self.repository = repository
+        self.version = None  # version of repository data the statistics are built from
+        self.days = defaultdict(lambda: [0, 0])  # date -> [number of marks, sum of marks]
+        self.months = defaultdict(lambda: [0, 0])  # (year, month) -> [number of marks, sum of marks]
+        self.students = None  # date -> {student id: number of marks on the date}, built on demand
+
+    def _refresh(self):
+        """Rebuilds statistics if repository data was re-read since they were built. Should be called under the lock"""
+        version = self.repository.refresh()
+        if version == self.version:
+            return
+        days, marks = self.repository.get_marks_columns()
+        self.days = defaultdict(lambda: [0, 0])
+        self.months = defaultdict(lambda: [0, 0])
+        self.students = None
+        if len(days):
+            first_day = int(days.min())
+            days = days.astype(np.int64) - first_day
+            counts = np.bincount(days)
+            sums = np.bincount(days, weights=marks)
+            for day in np.flatnonzero(counts).tolist():
+                date = datetime.date.fromordinal(first_day + day)
+                count, sum_ = int(counts[day]), int(sums[day])
+                self.days[date] = [count, sum_]
+                month = self.months[(date.year, date.month)]
+                month[0] += count
+                month[1] += sum_
+        self.version = version
+
+    def refresh(self):
+        """Builds statistics now. Should be called before the first add or remove: if a mark written to the
+        repository was indexed by the first build on another thread and then added, it would be counted twice"""
+        with self.lock:
+            self._refresh()
+
+    def add(self, id_: int, date: datetime.date, mark: int):
+        with self.lock:
+            for stats in (self.days[date], self.months[(date.year, date.month)]):
+                stats[0] += 1
+                stats[1] += mark
+            if self.students is not None:
+                self.students[date][id_] += 1
+
+    def add_students(self, students):
+        """Adds marks of many students, students is iterable of (id, marks) pairs"""
+        for id_, marks in students:
+            for date, mark in marks:
+                self.add(id_, date, mark)
+
+    def remove(self, id_: int, date: datetime.date, mark: int):
+        with self.lock:
+            for stats in (self.days[date], self.months[(date.year, date.month)]):
+                stats[0] -= 1
+                stats[1] -= mark
+            if self.students is not None:
+                graded = self.students[date]
+                graded[id_] -= 1
+                if graded[id_] == 0:
+                    del graded[id_]
+
+    @staticmethod
+    def _average(stats):
+        number_of_marks, sum_of_marks = stats
+        return sum_of_marks / number_of_marks if number_of_marks else None
+
+    def daily_average(self, date: datetime.date):
+        with self.lock:
+            self._refresh()
+            return self._average(self.days.get(date, (0, 0)))
+
+    def weekly_average(self, date: datetime.date):
+        """Returns average mark for the week (Monday - Sunday) that includes the date"""
+        monday = date - datetime.timedelta(days=date.weekday())
+        with self.lock:
+            self._refresh()
+            week = [self.days.get(monday + datetime.timedelta(days=i), (0, 0)) for i in range(7)]
+        return self._average((sum(stats[0] for stats in week), sum(stats[1] for stats in week)))
+
+    def monthly_average(self, year: int, month: int):
+        with self.lock:
+            self._refresh()
+            return self._average(self.months.get((year, month), (0, 0)))
+
+    def graded_students(self, date: datetime.date):
+        """Returns ids of students who got marks on the date"""
+        with self.lock:
+            self._refresh()
+            if self.students is None:
+                self.students = defaultdict(Counter)
+                for id_, student in self.repository.get_all_students().items():
+                    for mark_date, _ in student['marks']:
+                        self.students[mark_date][id_] += 1
+            return set(self.students.get(date, ()))
 
 # ######################################################################################################################
 # CRUD
@@ -207,24 +856,48 @@ class StudentService:
 
     def __init__(self, repository: AbstractRepository):
         self.repository = repository
+        self.marks_index = MarksIndex(repository)
+        self.marks_index.refresh()
 
     def add_student(self, name: str, marks: list[int] | None, details: str | None):
         student = {"name": name,
                    "marks": marks if marks else [],
                    "info": details if details else ""}
-        self.repository.add_student(student)
+        id_ = self.repository.add_student(student)
+        self.marks_index.add_students([(id_, student['marks'])])
+
+    def add_students(self, students: list[dict]):
+        """Adds many students at once. Each student is dict with 'name', 'marks' and 'info' keys"""
+        students = [{"name": student["name"],
+                     "marks": student["marks"] if student["marks"] else [],
+                     "info": student["info"] if student["info"] else ""} for student in students]
+        ids = self.repository.add_students(students)
+        self.marks_index.add_students((id_, student['marks']) for id_, student in zip(ids, students))
 
     def get_students(self):
         return self.repository.get_all_students()
 
+    def import_students(self, file_path, progress=None):
+        """Adds students from CSV file chunk by chunk, new ids are assigned to them"""
+        for chunk in read_students_csv(file_path, progress=progress):
+            self.add_students([student for _, student in chunk])
+
+    def export_students(self, file_path, progress=None):
+        """Writes all students to CSV file without building rows for all of them in memory"""
+        write_students_csv(file_path, self.repository.get_all_students().items(), progress=progress)
+
     def get_student_info(self, id_: int):
         return self.repository.get_student(id_)
 
     def remove_student(self, id_: int):
+        marks = list(self.repository.get_student(id_)['marks'])
         self.repository.delete_student(id_)
+        for date, mark in marks:
+            self.marks_index.remove(id_, date, mark)
 
     def add_mark(self, id_: int, mark: int, date: datetime.date):
         self.repository.add_mark(id_, mark, date)
+        self.marks_index.add(id_, date, mark)
 
     def update_student(self, id_: int, name: str|None=None, info: str|None=None):
         data = {}
@@ -237,6 +910,27 @@ class StudentService:
     def number_of_students(self):
         return len(self.repository)
 
+    def get_marks_columns(self):
+        return self.repository.get_marks_columns()
+
+    def daily_average(self, date: datetime.date):
+        return self.marks_index.daily_average(date)
+
+    def weekly_average(self, date: datetime.date):
+        return self.marks_index.weekly_average(date)
+
+    def monthly_average(self, year: int, month: int):
+        return self.marks_index.monthly_average(year, month)
+
+    def student_trend(self, id_: int):
+        """Returns list of (monday of the week, average mark for the week) for student in chronological order"""
+        weeks = defaultdict(lambda: [0, 0])
+        for date, mark in self.repository.get_student(id_)['marks']:
+            week = weeks[date - datetime.timedelta(days=date.weekday())]
+            week[0] += 1
+            week[1] += mark
+        return [(monday, sum_ / number) for monday, (number, sum_) in sorted(weeks.items())]
+
 # ######################################################################################################################
 # Command handlers
 # ######################################################################################################################
@@ -333,6 +1027,7 @@ def grade_student_handler(student_service: StudentService):
             answer = input('Would you like to add new mark for student? [y|yes / n|no]: ').strip().lower()
             if answer in ('y', 'yes'):
                 student_service.add_mark(id_, mark, datetime.date.today())
+                student = student_service.get_student_info(id_)
                 print_success(f"Updated marks for {student['name']}: {get_string_of_marks_to_display_one_student(student)}\n")
             else:
                 print_error('Action was cancelled\n')
@@ -365,22 +1060,72 @@ def update_student_handler(student_service: StudentService):
 
 
 def update_state(**kwargs):
-    """Updates state file with new values"""
+    """Updates state with new values and writes it through to the state file"""
+    global STATE
     with STATE_LOCK:
-        if not os.path.exists(STATE_FILE):
-            read_json = {}
-        else:
-            with open(STATE_FILE, 'r') as f:
-                read_json = json.load(f)
-        read_json.update(kwargs)
+        if STATE is None:
+            STATE = _read_state_file() if os.path.exists(STATE_FILE) else {}
+        STATE.update(kwargs)
         with open(STATE_FILE, 'w') as f:
-            json.dump(read_json, f)
+            json.dump(STATE, f)
+
+def _read_state_file():
+    with open(STATE_FILE, 'r') as f:
+        return json.load(f)
 
 def get_state(field):
-    """Returns field value from state file"""
+    """Returns field value from state, state file is read only once"""
+    global STATE
     with STATE_LOCK:
-        with open(STATE_FILE, 'r') as f:
-            return json.load(f)[field]
+        if STATE is None:
+            STATE = _read_state_file()
+        return STATE[field]
+
+class ReportScheduler:
+    """Runs periodic reports in one thread.
+
+    Reports are kept in heap ordered by the next due time, which is calculated from last run time
+    persisted in the state. Thread sleeps until the earliest report is due or new report is registered.
+    """
+
+    def __init__(self):
+        self.heap = []  # (due time, report name)
+        self.reports = {}  # report name -> (period, callback, state field)
+        self.condition = Condition()
+
+    def register(self, name: str, period: float, callback, state_field: str):
+        """Registers report. Callback returns True if report was sent, otherwise it is retried later"""
+        try:
+            last_run = get_state(state_field)
+        except (KeyError, FileNotFoundError):
+            last_run = time.time()
+            update_state(**{state_field: last_run})
+        with self.condition:
+            self.reports[name] = (period, callback, state_field)
+            heapq.heappush(self.heap, (last_run + period, name))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                _, name = heapq.heappop(self.heap)
+                period, callback, state_field = self.reports[name]
+
+            try:
+                if callback():
+                    last_run = time.time()
+                    update_state(**{state_field: last_run})
+                    due = last_run + period
+                else:
+                    due = time.time() + REPORT_RETRY_PERIOD
+            except Exception as error:  # the thread keeps running, so the other reports are not skipped
+                print_error(f"\nReport '{name}' failed: {error!r}, it is retried in {REPORT_RETRY_PERIOD} seconds\n")
+                due = time.time() + REPORT_RETRY_PERIOD
+
+            with self.condition:
+                heapq.heappush(self.heap, (due, name))
 
 def update_email_handler():
     global RECIPIENT_EMAIL
@@ -400,75 +1145,29 @@ def update_email_handler():
         update_state(email=None)
 
 def send_every_month_statistics(student_service: StudentService):
-    while True:
-        last_every_month = get_state('last_every_month')
-        if time.time() - last_every_month > EVERY_MONTH_PERIOD:
-            if RECIPIENT_EMAIL:
-                send_email(f"Digital Journal App - Monthly Report - {datetime.date.today()}",
-                           f"Today {datetime.date.today()}, {student_service.number_of_students()} student(s) are registered in Digital Journal App")
-                update_state(last_every_month=time.time())
-        else:
-            time.sleep(REPORT_PERIOD_CHECK)
+    """Sends monthly report, returns False if there is no email to send it to"""
+    if not RECIPIENT_EMAIL:
+        return False
+    last_month = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    average_mark = student_service.monthly_average(last_month.year, last_month.month)
+    if average_mark is not None:
+        average_mark = f"{average_mark:.2f}"
+    send_email(f"Digital Journal App - Monthly Report - {datetime.date.today()}",
+               f"Today {datetime.date.today()}, {student_service.number_of_students()} student(s) are registered in Digital Journal App\n"
+               f"Average mark for the last month ({last_month.strftime('%Y-%m')}) is {average_mark}")
+    return True
 
 def send_every_day_statistics(student_service: StudentService):
-    while True:
-        last_every_day = get_state('last_every_day')
-        if time.time() - last_every_day > EVERY_DAY_PERIOD:
-            if RECIPIENT_EMAIL:
-                search_date = (datetime.date.today() - datetime.timedelta(days=1))
-                students = student_service.get_students()
-
-                # # Average calculation with one process (for comparison)
-                # start = time.perf_counter()
-                # number_of_marks_for_period = 0
-                # sum_of_marks_for_period = 0
-                # for id, data in students.items():
-                #     for date, mark in data['marks']:
-                #         if date == search_date:
-                #             number_of_marks_for_period += 1
-                #             sum_of_marks_for_period += mark
-                # end = time.perf_counter()
-                # print(f"DURATION: {end-start}")
-
-                # Average calculation with several processes
-                start = time.perf_counter()
-                processes = []
-                number_of_marks = []
-                sum_of_marks = []
-                MAX_PROCESSES = cpu_count()
-
-                for chunk in split_dict_into_chunks(students, MAX_PROCESSES):
-                    number_of_marks_ret = Value('i')
-                    number_of_marks.append(number_of_marks_ret)
-                    sum_of_marks_ret = Value('i')
-                    sum_of_marks.append(sum_of_marks_ret)
-
-                    p = Process(target=_average_calc_helper, args=(chunk, search_date, number_of_marks_ret, sum_of_marks_ret))
-                    p.start()
-                    processes.append(p)
-
-                for p in processes:
-                    p.join()
-
-                try:
-                    average_mark = sum([sum_.value for sum_ in sum_of_marks]) / sum([num.value for num in number_of_marks])
-                    average_mark = f"{average_mark:.2f}"
-                except ZeroDivisionError:
-                    average_mark = None
-                end = time.perf_counter()
-                #print(f"DURATION: {end-start}")
-                send_email(f"Digital Journal App - Daily Report - {datetime.date.today()}",
-                           f"Average mark for yesterday ({datetime.date.today() - datetime.timedelta(days=1)}) is {average_mark}")
-                update_state(last_every_day=time.time())
-
-            """
-            Users                1000                   1000_000
-            One process         0.00040449993684887886  0.2397951000602916
-            CPU# processes      0.7411272999597713      9.727466400014237
-            """
-
-        else:
-            time.sleep(REPORT_PERIOD_CHECK)
+    """Sends daily report, returns False if there is no email to send it to"""
+    if not RECIPIENT_EMAIL:
+        return False
+    search_date = (datetime.date.today() - datetime.timedelta(days=1))
+    average_mark = student_service.daily_average(search_date)
+    if average_mark is not None:
+        average_mark = f"{average_mark:.2f}"
+    send_email(f"Digital Journal App - Daily Report - {datetime.date.today()}",
+               f"Average mark for yesterday ({search_date}) is {average_mark}")
+    return True
 
 
 def main():
@@ -487,9 +1186,15 @@ def main():
         Path(storage_file_path).touch()
         print("New storage file is created\n")
 
-    repository = Repository(storage_file_path)
+    if storage_file_path.endswith('.bin'):
+        repository = BinaryRepository(storage_file_path)
+    else:
+        repository = Repository(storage_file_path)
     student_service = StudentService(repository)
 
+    global MAIL_QUEUE
+    MAIL_QUEUE = MailQueue()
+
     # Create state file with current time if it doesn't exist
     if not os.path.exists(STATE_FILE):
         update_email_handler()
@@ -499,13 +1204,16 @@ def main():
         global RECIPIENT_EMAIL
         RECIPIENT_EMAIL = get_state('email')
 
-    Thread(target=send_every_month_statistics, args=(student_service,), daemon=True).start()
-    Thread(target=send_every_day_statistics, args=(student_service,), daemon=True).start()
+    report_scheduler = ReportScheduler()
+    report_scheduler.register('monthly', EVERY_MONTH_PERIOD, partial(send_every_month_statistics, student_service), 'last_every_month')
+    report_scheduler.register('daily', EVERY_DAY_PERIOD, partial(send_every_day_statistics, student_service), 'last_every_day')
+    Thread(target=report_scheduler.run, daemon=True).start()
 
     while True:
         command = input(f"Enter one of the commands: {COMMAND_LIST}: ").strip().lower()
         match command:
             case 'quit':
+                MAIL_QUEUE.close()  # reports waiting in the queue are sent before exit
                 print("Thank you for using Digital Journal App")
                 break
             case 'help':
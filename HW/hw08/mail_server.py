@@ -1,4 +1,7 @@
+import queue
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 
 
@@ -38,5 +41,126 @@ class SMTPService:
         """Close the connection."""
         self.server.quit()
 
-    def send(self, from_: str, to: str, message: Message) -> None:
+    def send(self, from_: str, to: str | list[str], message: Message) -> None:
         self.server.sendmail(msg=str(message), from_addr=from_, to_addrs=to)
+
+    def is_alive(self) -> bool:
+        """Checks that server didn't drop the connection"""
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+
+class MailQueue:
+    """Sends messages in background thread through one long-lived SMTP connection.
+
+    Messages which are waiting in the queue are sent in one session, the same message to several recipients
+    is sent once. Connection is reopened if server dropped it. Temporary failures (connection errors and 4xx replies)
+    are retried with exponential backoff, messages rejected with 5xx replies are dropped, as retry can't help them.
+    Connection is closed when there is nothing to send for idle_timeout seconds, close() sends the rest of the queue
+    and stops the thread.
+
+    For local testing run stand-in server: python -m aiosmtpd -n -l localhost:1025
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 1025, batch_size: int = 100,
+                 max_retries: int = 5, backoff: float = 1.0, idle_timeout: float = 60) -> None:
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.queue: queue.Queue[tuple[str, str, Message] | None] = queue.Queue()  # None stops the thread
+        self.service: SMTPService | None = None
+        self.thread = threading.Thread(target=self._process_queue, daemon=True)
+        self.thread.start()
+
+    def put(self, from_: str, to: str, message: Message) -> None:
+        """Adds message to the queue, doesn't wait for sending"""
+        self.queue.put((from_, to, message))
+
+    def join(self) -> None:
+        """Waits until all queued messages are processed"""
+        self.queue.join()
+
+    def close(self, timeout: float | None = None) -> None:
+        """Sends messages left in the queue, closes connection and stops background thread.
+        Messages put after close are not sent"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    @staticmethod
+    def _is_temporary(error: Exception) -> bool:
+        """Connection errors and 4xx replies could pass on retry, other errors (5xx replies) are permanent"""
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500 for code, _ in error.recipients.values())
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+    def _connect(self) -> None:
+        self.service = SMTPService(host=self.host, port=self.port).__enter__()
+
+    def _disconnect(self) -> None:
+        if self.service is not None:
+            try:
+                self.service.__exit__()
+            except (smtplib.SMTPException, OSError):
+                pass  # connection is already broken
+            self.service = None
+
+    def _process_queue(self) -> None:
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.idle_timeout)]
+            except queue.Empty:
+                self._disconnect()
+                continue
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closed = batch[-1] is None
+            messages = batch[:-1] if closed else batch
+            if messages:
+                self._send_batch(messages)
+            for _ in batch:
+                self.queue.task_done()
+            if closed:
+                self._disconnect()
+                return
+
+    def _send_batch(self, batch: list[tuple[str, str, Message]]) -> None:
+        # the same message to many recipients is sent with one command
+        envelopes: dict[tuple[str, str], tuple[Message, list[str]]] = {}
+        for from_, to, message in batch:
+            envelopes.setdefault((from_, str(message)), (message, []))[1].append(to)
+        pending = [(from_, message, recipients) for (from_, _), (message, recipients) in envelopes.items()]
+
+        for attempt in range(self.max_retries):
+            try:
+                if self.service is None or not self.service.is_alive():
+                    self._disconnect()
+                    self._connect()
+                while pending:
+                    from_, message, recipients = pending[0]
+                    try:
+                        self.service.send(from_=from_, to=recipients, message=message)
+                    except (smtplib.SMTPException, OSError) as e:
+                        if self._is_temporary(e):
+                            raise
+                        print(f"Email '{message.subject}' to {', '.join(map(str, recipients))} was rejected ({e})")
+                    pending.pop(0)
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                if not self._is_temporary(e):
+                    print(f"Sending email failed ({e}), it is not retried")
+                    self._disconnect()
+                    break
+                print(f"Sending email failed ({e}), attempt {attempt + 1} of {self.max_retries}")
+                self._disconnect()
+                time.sleep(self.backoff * 2 ** attempt)
+        print(f"{len(pending)} email(s) were not sent")
@@ -1,41 +1,51 @@
-import csv
+"""Generates storage file with random students
+
+Students are generated one by one and written to disk right away, so memory use doesn't depend on their number:
+    python random_data_generator.py 10000000 students.csv
+"""
 import datetime
 import random
+import sys
 
 from faker import Faker
 
+from journal import write_students_csv
+
 
 number_of_students = 10
 fake = Faker('en_GB')
 interests = ["music", "painting", "photo", "cooking", "planting", "dances", "sport"]
+NAMES_POOL_SIZE = 10_000  # Faker is slow, so names for millions of students are taken from the pool
+
 
-students = []
+def generate_students(number_of_students: int):
+    """Yields (id, student) pairs with marks in the past up to today (marks are missing for some days)"""
+    names = [fake.name() for _ in range(min(number_of_students, NAMES_POOL_SIZE))]
+    today = datetime.date.today()
+    for i in range(number_of_students):
+        marks = []
+        number_of_marks = random.randint(5, 9)
+        for j in range(number_of_marks):
+            if random.random() > 0.5:  # add if random > 0.5
+                date = today - datetime.timedelta(days=number_of_marks - j - 1)
+                mark = random.randint(1, 12)
+                marks.append((date, mark))
 
-for i in range(number_of_students):
-    name = fake.name()
+        student = {"name": random.choice(names),
+                   "marks": marks,
+                   "info": random.choice(['', f'{random.randint(15, 23)} y.o. Interests: {random.choice(interests)}'])}
+        yield i + 1, student
 
-    marks = []
-    number_of_marks = random.randint(5, 9)
-    for j in range(number_of_marks):
-        if random.random() > 0.5:  # add if random > 0.5
-            date = now = datetime.date.today() - datetime.timedelta(days=number_of_marks - j - 1)
-            mark = random.randint(1, 12)
-            marks.append((date, mark))
 
-    student = {"id": i + 1,
-               "name": name,
-               "marks": marks,
-               "info": random.choice(['', f'{random.randint(15, 23)} y.o. Interests: {random.choice(interests)}'])}
-    students.append(student)
+def print_progress(rows: int):
+    print(f"\r{rows} student(s) written", end='', flush=True)
+
 
 if __name__ == '__main__':
-    with open('students.csv', 'w', newline='') as csvfile:
-        fieldnames = ['id', 'name', 'info', 'marks']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for student in students:
-            writer.writerow({'id': student['id'],
-                             'name': student['name'],
-                             'info': student['info'],
-                             'marks': ','.join(f"{date_mark[0].strftime('%Y-%m-%d')}|{date_mark[1]}" for date_mark in student['marks'])})
\ No newline at end of file
+    if len(sys.argv) > 1:
+        number_of_students = int(sys.argv[1])
+    file_path = sys.argv[2] if len(sys.argv) > 2 else 'students.csv'
+
+    write_students_csv(file_path, generate_students(number_of_students), progress=print_progress,
+                       progress_step=max(number_of_students // 100, 1))
+    print()
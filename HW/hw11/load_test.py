@@ -0,0 +1,118 @@
+"""Load test for delivery of orders in scheduler.py
+
+A burst of orders, which are due at once, is added to Scheduler and shipped with fast providers.
+While they are shipped, number of threads and memory (RSS) of the process are sampled.
+Previous delivery with a thread per order is measured on the same burst for comparison:
+    python load_test.py --orders 1000 10000 30000 --shipping-time 0.5 --workers 200
+
+Orders      Delivery            Peak threads    Peak RSS growth, MB    Time, s
+1_000       thread per order    1002            15.5                   0.6
+1_000       bounded executors   404             6.0                    1.5
+10_000      thread per order    3549            47.6                   3.0
+10_000      bounded executors   406             1.4                    17.3
+30_000      thread per order    3488            38.6                   8.6
+30_000      bounded executors   408             3.9                    55.6
+
+Threads per order are limited only by how fast they are started: each lives for the shipping time.
+Bounded executors keep threads and memory flat, orders wait in DelayQueue of the scheduler.
+"""
+import argparse
+import contextlib
+import io
+import random
+import threading
+import time
+from datetime import datetime
+from unittest import mock
+
+import psutil
+
+from scheduler import BoundedExecutor, DeliveryProvider, Scheduler, Uber, Uklon
+
+ORDERS = (1_000, 10_000, 30_000)
+SAMPLE_PERIOD = 0.05  # seconds
+
+
+class Sampler:
+    """Samples number of threads and RSS of the process in background thread"""
+
+    def __init__(self):
+        self.process = psutil.Process()
+        self.base_rss = self.process.memory_info().rss
+        self.peak_threads = 0
+        self.peak_rss = self.base_rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_PERIOD):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+
+
+def thread_per_order(orders):
+    """Previous behaviour of Scheduler.delivery_orders"""
+    for order in orders:
+        provider = random.choice([Uklon, Uber])()
+        threading.Thread(target=provider.ship, args=(order,)).start()
+
+
+def bounded_executors(orders):
+    scheduler = Scheduler()
+    threading.Thread(target=scheduler.process_orders, daemon=True).start()
+    threading.Thread(target=scheduler.delivery_orders, daemon=True).start()
+    for order in orders:
+        scheduler.add_order(order)
+
+
+def run(deliver, number_of_orders: int):
+    """Returns peak threads, peak RSS growth in MB and seconds until all orders are delivered"""
+    delivered = threading.Semaphore(0)
+    ship = DeliveryProvider.ship
+
+    def counted_ship(self, order):
+        ship(self, order)
+        delivered.release()
+
+    now = datetime.now()
+    orders = [(f"Order {i}", now) for i in range(number_of_orders)]
+    with mock.patch.object(DeliveryProvider, "ship", counted_ship), \
+            contextlib.redirect_stdout(io.StringIO()), Sampler() as sampler:
+        start = time.perf_counter()
+        deliver(orders)
+        for _ in range(number_of_orders):
+            delivered.acquire()
+        seconds = time.perf_counter() - start
+    return sampler.peak_threads, (sampler.peak_rss - sampler.base_rss) / 2 ** 20, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, nargs="+", default=ORDERS, help="numbers of orders in a burst")
+    parser.add_argument("--shipping-time", type=float, default=0.5, help="seconds of shipping for every provider")
+    parser.add_argument("--workers", type=int, default=200, help="orders shipped at once by every provider")
+    args = parser.parse_args()
+
+    for provider in (Uklon, Uber):
+        provider.SHIPPING_TIME = args.shipping_time
+        provider.MAX_ACTIVE_SHIPPING = args.workers
+        provider.executor = BoundedExecutor(args.workers, args.workers, provider.__name__)
+
+    print(f"{'Orders':<12}{'Delivery':<20}{'Peak threads':<16}{'Peak RSS growth, MB':<23}{'Time, s':<10}")
+    for number_of_orders in args.orders:
+        for deliver in (thread_per_order, bounded_executors):
+            threads, rss, seconds = run(deliver, number_of_orders)
+            name = deliver.__name__.replace("_", " ")
+            print(f"{number_of_orders:<12_}{name:<20}{threads:<16}{rss:<23.1f}{seconds:<10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
-from abc import ABC, abstractmethod
+from abc import ABC
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+import heapq
+import itertools
 import queue
 import random
 import threading
@@ -7,6 +11,9 @@ import time
 
 OrderRequestBody = tuple[str, datetime]
 
+SHIPPING_QUEUE_SIZE = 1000  # orders waiting for a provider, when it is full ready orders stay in DelayQueue
+EWMA_ALPHA = 0.2  # weight of the last shipping time in provider latency
+
 
 storage = {
     "users": [],
@@ -34,25 +41,55 @@ storage = {
 }
 
 
+class DelayQueue:
+    """Orders in a heap by due time.
+
+    get() blocks until the earliest order is due, put() wakes a waiting thread to look
+    at the head again, so nothing is polled. A thread which takes an order wakes the next
+    one, if more orders are left, so all consumers are kept busy.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, OrderRequestBody]] = []
+        self._counter = itertools.count()  # orders due at the same time keep the order of adding
+        self._condition = threading.Condition()
+
+    def put(self, order: OrderRequestBody) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (order[1], next(self._counter), order))
+            self._condition.notify()
+
+    def get(self) -> OrderRequestBody:
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                time_to_wait = (self._heap[0][0] - datetime.now()).total_seconds()
+                if time_to_wait <= 0:
+                    order = heapq.heappop(self._heap)[2]
+                    if self._heap:
+                        self._condition.notify()
+                    return order
+                self._condition.wait(time_to_wait)
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+
 class Scheduler:
     def __init__(self):
-        self.orders: queue.Queue[OrderRequestBody] = queue.Queue()
-        self.shipping_orders: queue.Queue[OrderRequestBody] = queue.Queue()
+        self.orders = DelayQueue()
+        self.shipping_orders: queue.Queue[OrderRequestBody] = queue.Queue(maxsize=SHIPPING_QUEUE_SIZE)
+        self.dispatcher = ProviderDispatcher({provider: provider.SHIPPING_TIME for provider in (Uklon, Uber)})
 
     def process_orders(self) -> None:
         print("SCHEDULER PROCESSING...")
 
         while True:
-            order = self.orders.get(True)
-
-            time_to_wait = order[1] - datetime.now()
-
-            if time_to_wait.total_seconds() > 0:
-                self.orders.put(order)
-                time.sleep(0.5)
-            else:
-                self.shipping_orders.put(order)
-                print(f"\n\t{order[0]} SENT TO SHIPPING DEPARTMENT")
+            order = self.orders.get()
+            self.shipping_orders.put(order)
+            print(f"\n\t{order[0]} SENT TO SHIPPING DEPARTMENT")
 
     def delivery_orders(self):
         print("SCHEDULER SHIPPING...")
@@ -60,53 +97,128 @@ class Scheduler:
         while True:
             order = self.shipping_orders.get(True)
 
-            def _get_delivery_provider():
-                """Returns less loaded delivery provider"""
-                uklon_active_shipping = Uklon.NUMBER_OF_ACTIVE_SHIPPING
-                uber_active_shipping = Uber.NUMBER_OF_ACTIVE_SHIPPING
-                #print(f"Uklon = {uklon_active_shipping}, Uber = {uber_active_shipping}")
-
-                if uklon_active_shipping < uber_active_shipping:
-                    return Uklon()
-                elif uber_active_shipping < uklon_active_shipping:
-                    return Uber()
-                else:
-                    return random.choice([Uklon, Uber])()
-
-            delivery_provider: DeliveryProvider = _get_delivery_provider()
-            delivery_thread = threading.Thread(target=delivery_provider.ship, args=(order,))
-            delivery_thread.start()
+            provider = self.dispatcher.acquire()
+            # blocks while the provider is busy, so shipping_orders and then DelayQueue hold the rest
+            provider.executor.submit(self._ship, provider, order)
 
+    def _ship(self, provider: type["DeliveryProvider"], order: OrderRequestBody) -> None:
+        start = time.monotonic()
+        try:
+            provider().ship(order)
+        finally:
+            self.dispatcher.release(provider, time.monotonic() - start)
 
     def add_order(self, order: OrderRequestBody) -> None:
         self.orders.put(order)
         print(f"\n\t{order[0]} ADDED FOR PROCESSING")
 
 
-class DeliveryProvider(ABC):
-    NUMBER_OF_ACTIVE_SHIPPING = 0
+class BoundedExecutor:
+    """ThreadPoolExecutor with limited number of waiting tasks.
 
-    @abstractmethod
-    def ship(self, order: OrderRequestBody):
-        pass
+    submit() blocks when max_workers tasks are running and queue_size more are waiting,
+    so a burst of orders does not start a thread per order or pile up in executor queue.
+    """
 
+    def __init__(self, max_workers: int, queue_size: int = 0, thread_name_prefix: str = ""):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
 
-class Uklon(DeliveryProvider):
+    def submit(self, fn, *args) -> Future:
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
 
-    def ship(self, order: OrderRequestBody):
-        Uklon.NUMBER_OF_ACTIVE_SHIPPING += 1
-        time.sleep(5)
-        print(f"\tOrder {order[0]} is delivered by {self.__class__.__name__}")
-        Uklon.NUMBER_OF_ACTIVE_SHIPPING -= 1
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait)
 
 
-class Uber(DeliveryProvider):
+class DeliveryProvider(ABC):
+    SHIPPING_TIME: float  # seconds
+    MAX_ACTIVE_SHIPPING = 50  # orders shipped by the provider at once, as many more wait in its executor
+    executor: BoundedExecutor
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.executor = BoundedExecutor(cls.MAX_ACTIVE_SHIPPING, cls.MAX_ACTIVE_SHIPPING, cls.__name__)
 
     def ship(self, order: OrderRequestBody):
-        Uber.NUMBER_OF_ACTIVE_SHIPPING += 1
-        time.sleep(3)
+        time.sleep(self.SHIPPING_TIME)
         print(f"\tOrder {order[0]} is delivered by {self.__class__.__name__}")
-        Uber.NUMBER_OF_ACTIVE_SHIPPING -= 1
+
+
+class Uklon(DeliveryProvider):
+    SHIPPING_TIME = 5
+
+
+class Uber(DeliveryProvider):
+    SHIPPING_TIME = 3
+
+
+@dataclass
+class ProviderStats:
+    capacity: int  # orders shipped at once
+    latency: float  # EWMA of shipping seconds
+    in_flight: int = 0  # dispatched and not shipped yet
+    shipped: int = 0
+
+
+class ProviderDispatcher:
+    """Routes orders to providers with the least outstanding work and keeps their metrics.
+
+    Outstanding work is the expected time to ship new order: latency of provider and waiting
+    for a free thread, if all of them are busy. Two random providers are compared (power of two choices),
+    so the choice does not scan all providers. Counters are changed under one lock.
+    """
+
+    def __init__(self, providers: dict[type[DeliveryProvider], float]):
+        """providers with expected shipping seconds, which are used until real ones are measured"""
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._stats = {
+            provider: ProviderStats(capacity=provider.MAX_ACTIVE_SHIPPING, latency=latency)
+            for provider, latency in providers.items()
+        }
+
+    @staticmethod
+    def _outstanding_work(stats: ProviderStats) -> float:
+        waiting = max(0, stats.in_flight + 1 - stats.capacity)
+        return stats.latency * (1 + waiting / stats.capacity)
+
+    def acquire(self) -> type[DeliveryProvider]:
+        """choose provider for an order and count the order in flight"""
+        with self._lock:
+            candidates = random.sample(list(self._stats), min(2, len(self._stats)))
+            provider = min(candidates, key=lambda candidate: self._outstanding_work(self._stats[candidate]))
+            self._stats[provider].in_flight += 1
+            return provider
+
+    def release(self, provider: type[DeliveryProvider], seconds: float) -> None:
+        """mark order of provider as shipped in given seconds"""
+        with self._lock:
+            stats = self._stats[provider]
+            stats.in_flight -= 1
+            stats.shipped += 1
+            stats.latency += EWMA_ALPHA * (seconds - stats.latency)
+
+    def metrics(self) -> dict[str, dict[str, float]]:
+        """in flight and shipped orders, latency in seconds and throughput in orders per second of providers"""
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                provider.__name__: {
+                    "in_flight": stats.in_flight,
+                    "shipped": stats.shipped,
+                    "latency": round(stats.latency, 3),
+                    "throughput": round(stats.shipped / elapsed, 3),
+                }
+                for provider, stats in self._stats.items()
+            }
 
 
 def main():
@@ -119,8 +231,12 @@ def main():
     # user input:
     # A 5 (in 5 days)
     # B 3 (in 3 days)
+    # metrics (prints metrics of delivery providers)
     while True:
         order_details = input("Enter order details: ")
+        if order_details == "metrics":
+            print(scheduler.dispatcher.metrics())
+            continue
         data = order_details.split(" ")
         order_name = data[0]
         delay = datetime.now() + timedelta(seconds=int(data[1]))
@@ -1,16 +1,29 @@
 import enum
+import json
+import os
+import queue
+import tempfile
 import uuid
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 import random
 import abc
-import queue
+import heapq
+import itertools
 import threading
 import time
 from datetime import datetime, timedelta
-from typing import Literal
+from pathlib import Path
+from typing import Callable
 
-CHECK_ORDER_DELAY = 2
 ARCHIVE_ORDER_DELAY = 10
+# cold storage of archived orders, it is kept out of the source tree unless ARCHIVE_FILE env variable points there
+ARCHIVE_FILE = Path(os.getenv("ARCHIVE_FILE", Path(tempfile.gettempdir()) / "archived_orders.jsonl"))
+ORDER_WORKERS = 4  # threads passing due orders to providers, one of them may wait for a busy provider
+DELIVERY_WORKERS = 1  # threads reporting delivered orders
+ARCHIVE_WORKERS = 4  # threads moving orders to cold storage
+EWMA_ALPHA = 0.2  # weight of the last shipping time in provider latency
 
 class OrderStatus(enum.StrEnum):
     ONGOING = enum.auto()
@@ -19,11 +32,101 @@ class OrderStatus(enum.StrEnum):
     ARCHIVED = enum.auto()
 
 
+# statuses, to which order can be moved from the status (None for new order)
+TRANSITIONS: dict[OrderStatus | None, set[OrderStatus]] = {
+    None: {OrderStatus.ONGOING},
+    OrderStatus.ONGOING: {OrderStatus.FINISHED},
+    OrderStatus.FINISHED: {OrderStatus.ARCHIVING},
+    OrderStatus.ARCHIVING: {OrderStatus.ARCHIVED},
+    OrderStatus.ARCHIVED: set(),
+}
+
+
+class ColdStorage:
+    """Archived orders appended to JSON lines file"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, order_id: uuid.UUID, provider: str) -> None:
+        line = json.dumps({"id": str(order_id), "provider": provider, "archived": datetime.now().isoformat()})
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+class DeliveryStore:
+    """Delivery orders with their providers and statuses.
+
+    Besides the dict by id, ids are kept in a set per status, and status is changed only by transition(),
+    so watchers get (order id, provider) from queues of subscribe() instead of scanning all orders.
+    Archived orders are moved to cold storage and removed from memory.
+    """
+
+    def __init__(self, cold_storage: ColdStorage):
+        self._lock = threading.Lock()
+        self._orders: dict[uuid.UUID, list] = {}  # id: [provider, status]
+        self._by_status: dict[OrderStatus, set[uuid.UUID]] = {status: set() for status in OrderStatus}
+        self._watchers: dict[OrderStatus, list[queue.Queue]] = defaultdict(list)
+        self._archived = 0
+        self._cold_storage = cold_storage
+
+    def subscribe(self, status: OrderStatus) -> queue.Queue[tuple[uuid.UUID, str]]:
+        """return queue, which gets (order id, provider) of every order moved to the status from now on"""
+        watcher = queue.Queue()
+        with self._lock:
+            self._watchers[status].append(watcher)
+        return watcher
+
+    def add(self, order_id: uuid.UUID, provider: str) -> None:
+        self.transition(order_id, OrderStatus.ONGOING, provider)
+
+    def transition(self, order_id: uuid.UUID, status: OrderStatus, provider: str | None = None) -> None:
+        with self._lock:
+            order = self._orders.get(order_id)
+            current = order[1] if order else None
+            if status not in TRANSITIONS[current]:
+                raise ValueError(f"Order {order_id} can not be moved from {current} to {status}")
+
+            if order is None:
+                order = self._orders[order_id] = [provider, status]
+            else:
+                self._by_status[current].discard(order_id)
+                order[1] = status
+
+            if status == OrderStatus.ARCHIVED:
+                del self._orders[order_id]
+                self._archived += 1
+            else:
+                self._by_status[status].add(order_id)
+            watchers = list(self._watchers[status])
+
+        if status == OrderStatus.ARCHIVED:
+            self._cold_storage.append(order_id, order[0])
+        for watcher in watchers:
+            watcher.put((order_id, order[0]))
+
+    def get(self, order_id: uuid.UUID) -> tuple[str, OrderStatus] | None:
+        """return provider and status of not archived order"""
+        with self._lock:
+            order = self._orders.get(order_id)
+            return tuple(order) if order else None
+
+    def ids(self, status: OrderStatus) -> set[uuid.UUID]:
+        with self._lock:
+            return set(self._by_status[status])
+
+    def counts(self) -> dict[OrderStatus, int]:
+        with self._lock:
+            counts = {status: len(ids) for status, ids in self._by_status.items()}
+            counts[OrderStatus.ARCHIVED] = self._archived
+            return counts
+
+
 OrderRequestBody = tuple[str, datetime]
-DeliveryProvider = Literal["Uklon", "Uber"]
 
 storage = {
-    "delivery": {},  # id: [provider, status]
+    "delivery": DeliveryStore(ColdStorage(ARCHIVE_FILE)),
     "users": [],
     "dishes": [
         {
@@ -49,6 +152,62 @@ storage = {
 }
 
 
+class BoundedExecutor:
+    """ThreadPoolExecutor with limited number of waiting tasks.
+
+    submit() blocks when max_workers tasks are running and queue_size more are waiting,
+    so a burst of orders does not start a thread per order or pile up in executor queue.
+    """
+
+    def __init__(self, max_workers: int, queue_size: int = 0, thread_name_prefix: str = ""):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+
+    def submit(self, fn, *args) -> Future:
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait)
+
+
+class Stage:
+    """Step of order lifecycle: workers take items from source queue and pass them to handler.
+
+    Source is any queue with blocking get(): queue of lifecycle events from DeliveryStore.subscribe()
+    or DelayQueue of orders, which are due later. So stages wait for events instead of polling.
+    """
+
+    def __init__(self, name: str, source, handler: Callable, workers: int = 1):
+        self.name = name
+        self.source = source
+        self.handler = handler
+        self.workers = workers
+        self.processed = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        print(f"{self.name.upper()} PROCESSING...")
+        for number in range(self.workers):
+            threading.Thread(target=self._work, name=f"{self.name}-{number}", daemon=True).start()
+
+    def _work(self) -> None:
+        while True:
+            item = self.source.get()
+            try:
+                self.handler(item)
+            except Exception as error:  # the worker keeps running for next items
+                print(f"\n\t❗ {self.name} failed on {item}: {error!r}")
+            with self._lock:
+                self.processed += 1
+
+
 @dataclass
 class DeliveryOrder:
     order_name: str
@@ -56,170 +215,228 @@ class DeliveryOrder:
 
 
 class DeliveryService(abc.ABC):
-    def __init__(self, order: DeliveryOrder):
+    SHIPPING_TIME: tuple[int, int]  # range of seconds
+    MAX_ACTIVE_SHIPPING = 50  # orders shipped by the provider at once, as many more wait in its executor
+    executor: BoundedExecutor
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.executor = BoundedExecutor(cls.MAX_ACTIVE_SHIPPING, cls.MAX_ACTIVE_SHIPPING, cls.__name__)
+
+    def __init__(self, order: DeliveryOrder,
+                 on_shipped: Callable[[type["DeliveryService"], float], None] | None = None):
         self._order: DeliveryOrder = order
+        self._on_shipped = on_shipped  # called with provider and seconds of shipping
 
-    @abc.abstractmethod
     def ship(self) -> None:
         """resolve the order with concrete provider"""
 
-    @classmethod
-    def _process_delivery(cls) -> None:
-        """background process"""
-
-        print("DELIVERY PROCESSING...")
-
-        while True:
-            # if not (delivery_orders := storage["delivery"]):
-            #     time.sleep(1)
-            #     continue
-            # else:
-
-            filtered = {k: v for k, v in storage["delivery"].items() if v[1] == OrderStatus.ONGOING}
+        provider_name = self.__class__.__name__
 
-            # for order_id, value in filtered.items():
-            # orders_to_remove: set[uuid.UUID] = set()
+        self._order.number = uuid.uuid4()
+        storage["delivery"].add(self._order.number, provider_name)
+        delay: float = random.randint(*self.SHIPPING_TIME)
 
-            for order_id, value in filtered.items():
-                if value[1] == OrderStatus.FINISHED:
-                    print(f"\n\t🚚 Order {order_id} is delivered by {value[0]}")
-                    # orders_to_remove.add(order_id)
+        print(f"\n\t🚚 {provider_name} Shipping {self._order} with {delay} delay")
+        self._ship(delay)
 
-            # for order_id in orders_to_remove:
-            #     del storage["delivery"][order_id]
-            #     print(f"\n\t❌ REMOVED {order_id} from storage")
+    @staticmethod
+    def stages() -> list[Stage]:
+        return [Stage("delivery", storage["delivery"].subscribe(OrderStatus.FINISHED), DeliveryService._report,
+                      DELIVERY_WORKERS)]
 
-            time.sleep(CHECK_ORDER_DELAY)
+    @staticmethod
+    def _report(event: tuple[uuid.UUID, str]) -> None:
+        order_id, provider_name = event
+        print(f"\n\t🚚 Order {order_id} is delivered by {provider_name}")
 
     def _ship(self, delay: float):
 
         def _callback():
-            time.sleep(delay)
-            storage["delivery"][self._order.number] = (
-                self.__class__.__name__, OrderStatus.FINISHED
-            )
-            print(f"🚚 DELIVERED {self._order}")
+            start = time.monotonic()
+            try:
+                time.sleep(delay)
+                storage["delivery"].transition(self._order.number, OrderStatus.FINISHED)
+                print(f"🚚 DELIVERED {self._order}")
+            finally:
+                if self._on_shipped:
+                    self._on_shipped(self.__class__, time.monotonic() - start)
 
-        thread = threading.Thread(target=_callback)
-        thread.start()
+        # blocks while all threads of the provider are busy, so ready orders wait in the DelayQueue
+        self.executor.submit(_callback)
 
 
 class Uklon(DeliveryService):
-    def ship(self) -> None:
-        provider_name = self.__class__.__name__
-
-        self._order.number = uuid.uuid4()
-        storage["delivery"][self._order.number] = [provider_name, OrderStatus.ONGOING]
-        delay: float = random.randint(1, 3)
-
-        print(f"\n\t🚚 {provider_name} Shipping {self._order} with {delay} delay")
-        self._ship(delay)
+    SHIPPING_TIME = (1, 3)
 
 
 class Uber(DeliveryService):
-    def ship(self) -> None:
-        provider_name = self.__class__.__name__
+    SHIPPING_TIME = (3, 5)
 
-        self._order.number = uuid.uuid4()
-        storage["delivery"][self._order.number] = [provider_name, OrderStatus.ONGOING]
-        delay: float = random.randint(3, 5)
-        print(f"\n\t🚚 {provider_name} Shipping {self._order} with {delay} delay")
-        self._ship(delay)
 
+@dataclass
+class ProviderStats:
+    capacity: int  # orders shipped at once
+    latency: float  # EWMA of shipping seconds
+    in_flight: int = 0  # dispatched and not shipped yet
+    shipped: int = 0
+
+
+class ProviderDispatcher:
+    """Routes orders to providers with the least outstanding work and keeps their metrics.
+
+    Outstanding work is the expected time to ship new order: latency of provider and waiting
+    for a free thread, if all of them are busy. Two random providers are compared (power of two choices),
+    so the choice does not scan all providers. Counters are changed under one lock.
+    """
+
+    def __init__(self, providers: dict[type[DeliveryService], float]):
+        """providers with expected shipping seconds, which are used until real ones are measured"""
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._stats = {
+            provider: ProviderStats(capacity=provider.MAX_ACTIVE_SHIPPING, latency=latency)
+            for provider, latency in providers.items()
+        }
 
-class ArchiveService:
+    @staticmethod
+    def _outstanding_work(stats: ProviderStats) -> float:
+        waiting = max(0, stats.in_flight + 1 - stats.capacity)
+        return stats.latency * (1 + waiting / stats.capacity)
+
+    def acquire(self) -> type[DeliveryService]:
+        """choose provider for an order and count the order in flight"""
+        with self._lock:
+            candidates = random.sample(list(self._stats), min(2, len(self._stats)))
+            provider = min(candidates, key=lambda candidate: self._outstanding_work(self._stats[candidate]))
+            self._stats[provider].in_flight += 1
+            return provider
+
+    def release(self, provider: type[DeliveryService], seconds: float) -> None:
+        """mark order of provider as shipped in given seconds"""
+        with self._lock:
+            stats = self._stats[provider]
+            stats.in_flight -= 1
+            stats.shipped += 1
+            stats.latency += EWMA_ALPHA * (seconds - stats.latency)
+
+    def metrics(self) -> dict[str, dict[str, float]]:
+        """in flight and shipped orders, latency in seconds and throughput in orders per second of providers"""
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                provider.__name__: {
+                    "in_flight": stats.in_flight,
+                    "shipped": stats.shipped,
+                    "latency": round(stats.latency, 3),
+                    "throughput": round(stats.shipped / elapsed, 3),
+                }
+                for provider, stats in self._stats.items()
+            }
 
-    @classmethod
-    def _archive_orders(cls) -> None:
-        """background process"""
 
-        print("ORDERS ARCHIVING...")
+class ArchiveService:
 
-        while True:
+    @staticmethod
+    def stages() -> list[Stage]:
+        """orders are marked as archiving, when they are finished, and archived ARCHIVE_ORDER_DELAY later"""
 
-            filtered = {k: v for k, v in storage["delivery"].items() if v[1] == OrderStatus.FINISHED}
+        to_archive = DelayQueue()
 
-            for order_id, value in filtered.items():
-                ArchiveService._archive(order_id)
+        def _schedule(event: tuple[uuid.UUID, str]) -> None:
+            order_id, _ = event
+            storage["delivery"].transition(order_id, OrderStatus.ARCHIVING)
+            to_archive.put((order_id, datetime.now() + timedelta(seconds=ARCHIVE_ORDER_DELAY)))
 
-            time.sleep(CHECK_ORDER_DELAY)
+        return [
+            Stage("archiving", storage["delivery"].subscribe(OrderStatus.FINISHED), _schedule),
+            Stage("archive", to_archive, ArchiveService._archive, ARCHIVE_WORKERS),
+        ]
 
     @staticmethod
-    def _archive(order_id):
+    def _archive(order: tuple[uuid.UUID, datetime]) -> None:
+        order_id, _ = order
+        print(f"\t🗄️ Archiving order {order_id}...")
+        storage["delivery"].transition(order_id, OrderStatus.ARCHIVED)
+        print(f"🗄️ ARCHIVED order {order_id}")
 
-        def _callback():
-            print(f"\t🗄️ Archiving order {order_id}...")
-            storage["delivery"][order_id] = (storage["delivery"][order_id][0], OrderStatus.ARCHIVING)
-            time.sleep(ARCHIVE_ORDER_DELAY - CHECK_ORDER_DELAY)
-            # TODO: here could be added archiving logic
-            storage["delivery"][order_id] = (storage["delivery"][order_id][0], OrderStatus.ARCHIVED)
-            print(f"🗄️ ARCHIVED order {order_id}")
 
-        thread = threading.Thread(target=_callback)
-        thread.start()
+class DelayQueue:
+    """Orders in a heap by due time.
 
+    get() blocks until the earliest order is due, put() wakes a waiting thread to look
+    at the head again, so nothing is polled. A thread which takes an order wakes the next
+    one, if more orders are left, so all consumers are kept busy.
+    """
 
-class Scheduler:
     def __init__(self):
-        self.orders: queue.Queue[OrderRequestBody] = queue.Queue()
+        self._heap: list[tuple[datetime, int, OrderRequestBody]] = []
+        self._counter = itertools.count()  # orders due at the same time keep the order of adding
+        self._condition = threading.Condition()
+
+    def put(self, order: OrderRequestBody) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (order[1], next(self._counter), order))
+            self._condition.notify()
+
+    def get(self) -> OrderRequestBody:
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                time_to_wait = (self._heap[0][0] - datetime.now()).total_seconds()
+                if time_to_wait <= 0:
+                    order = heapq.heappop(self._heap)[2]
+                    if self._heap:
+                        self._condition.notify()
+                    return order
+                self._condition.wait(time_to_wait)
+
+    def qsize(self) -> int:
+        return len(self._heap)
 
-    @staticmethod
-    def _service_dispatcher() -> type[DeliveryService]:
-        random_provider: DeliveryProvider = random.choice(("Uklon", "Uber"))
 
-        match random_provider:
-            case "Uklon":
-                return Uklon
-            case "Uber":
-                return Uber
-            # case _:
-            #     raise Exception("Not recognized delivery provider")
+class Scheduler:
+    def __init__(self):
+        self.orders = DelayQueue()
+        self.dispatcher = ProviderDispatcher(
+            {provider: sum(provider.SHIPPING_TIME) / 2 for provider in (Uklon, Uber)}
+        )
 
     def ship_order(self, order_name: str) -> None:
-        ConcreteDeliveryService: type[DeliveryService] = self._service_dispatcher()
-        instance = ConcreteDeliveryService(order=DeliveryOrder(order_name=order_name))
+        ConcreteDeliveryService: type[DeliveryService] = self.dispatcher.acquire()
+        instance = ConcreteDeliveryService(
+            order=DeliveryOrder(order_name=order_name), on_shipped=self.dispatcher.release
+        )
         instance.ship()
 
     def add_order(self, order: OrderRequestBody) -> None:
         self.orders.put(order)
         print(f"\n\t{order[0]} ADDED FOR PROCESSING")
 
-    def process_orders(self) -> None:
-        print("ORDERS PROCESSING...")
-
-        while True:
-            order = self.orders.get(True)
-
-            time_to_wait = order[1] - datetime.now()
-
-            if time_to_wait.total_seconds() > 0:
-                self.orders.put(order)
-                time.sleep(0.5)
-            else:
-                self.ship_order(order[0])
-                # print(f"\n\t{order[0]} SENT TO SHIPPING DEPARTMENT")
+    def stages(self) -> list[Stage]:
+        return [Stage("orders", self.orders, lambda order: self.ship_order(order[0]), ORDER_WORKERS)]
 
 
 def main():
     scheduler = Scheduler()
-    process_orders_thread = threading.Thread(
-        target=scheduler.process_orders, daemon=True
-    )
-    process_delivery_thread = threading.Thread(
-        target=DeliveryService._process_delivery, daemon=True
-    )
-    archive_orders_thread = threading.Thread(
-        target=ArchiveService._archive_orders, daemon=True
-    )
-    process_orders_thread.start()
-    process_delivery_thread.start()
-    archive_orders_thread.start()
+    # order -> DelayQueue -> orders -> provider executor -> FINISHED -> delivery, archiving -> DelayQueue -> archive
+    stages = [*scheduler.stages(), *DeliveryService.stages(), *ArchiveService.stages()]
+    for stage in stages:
+        stage.start()
 
     # user input:
     # A 5 (in 5 days)
     # B 3 (in 3 days)
+    # metrics (prints metrics of delivery providers, numbers of orders by status and processed by stages)
     while True:
         order_details = input("Enter order details: ")
+        if order_details == "metrics":
+            print(scheduler.dispatcher.metrics())
+            print(storage["delivery"].counts())
+            print({stage.name: stage.processed for stage in stages})
+            continue
         data = order_details.split(" ")
         order_name = data[0]
         delay = datetime.now() + timedelta(seconds=int(data[1]))
@@ -1,8 +1,20 @@
+import atexit
+import time
 from datetime import date
-from dataclasses import dataclass
+from collections import OrderedDict, defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from functools import cache
+from graphlib import TopologicalSorter
+from itertools import count, islice
 from pprint import pprint as print
+from threading import Lock, local
+from typing import Any, ClassVar, Self
 
 import psycopg
+from psycopg.rows import args_row, dict_row
+from psycopg_pool import ConnectionPool
 
 connection_payload = {
     "dbname": "hilleldb",
@@ -12,426 +24,1274 @@ connection_payload = {
     "port": 5432,
 }
 
+pool_settings = {
+    "min_size": 2,
+    "max_size": 10,
+    "max_idle": 300,  # seconds before idle connection above min_size is closed
+    "timeout": 30,  # seconds to wait for free connection
+    "check": ConnectionPool.check_connection,  # drop broken connections on checkout
+}
+
+_pool: ConnectionPool | None = None
+_pool_lock = Lock()
+_checkout = local()  # connection taken by current thread and depth of nested DatabaseConnection blocks
+
+BATCH_SIZE = 2_000  # rows fetched by server-side cursor at once
+_cursor_numbers = count()
+_models: dict[tuple[str, str], type["Model"]] = {}  # by module and class name, to resolve relations
+CACHE_SIZE = 10_000  # rows in model_cache
+ANALYZE_THRESHOLD = 10_000  # rows inserted by bulk_create, after which table statistics are updated
+
+
+class QueryCounter:
+    """Counts SQL statements executed by ORM in current thread.
+
+        with QueryCounter() as counter:
+            orders = list(Order.all().prefetch_related("items__dish"))
+        print(counter.count, counter.queries)
+
+    Fetching next batch of rows from server-side cursor is not counted.
+    """
+
+    def __init__(self):
+        self.queries: list[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.queries)
+
+    def __enter__(self):
+        if not hasattr(_checkout, "counters"):
+            _checkout.counters = []
+        _checkout.counters.append(self)
+        return self
+
+    def __exit__(self, *_):
+        _checkout.counters.remove(self)
+
+    @staticmethod
+    def record(query) -> None:
+        if not query:  # health check of the pool
+            return
+        for counter in getattr(_checkout, "counters", ()):
+            counter.queries.append(str(query))
+
+
+class _CountedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        QueryCounter.record(query)
+        return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        QueryCounter.record(query)
+        return super().executemany(query, params_seq, **kwargs)
+
+    def copy(self, statement, params=None, **kwargs):
+        QueryCounter.record(statement)
+        return super().copy(statement, params, **kwargs)
+
+
+class _CountedServerCursor(psycopg.ServerCursor):
+    def execute(self, query, params=None, **kwargs):
+        QueryCounter.record(query)
+        return super().execute(query, params, **kwargs)
+
+
+def _configure(conn: psycopg.Connection) -> None:
+    conn.cursor_factory = _CountedCursor
+    conn.server_cursor_factory = _CountedServerCursor
+
+
+def get_pool() -> ConnectionPool:
+    """return connection pool, it is opened on first use."""
+
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(kwargs=connection_payload, configure=_configure, open=True, **pool_settings)
+                atexit.register(close_pool)
+    return _pool
+
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
 
 class DatabaseConnection:
+    """Takes connection from the pool for current thread.
+
+    Nested blocks in the same thread reuse the connection. The outermost block is a transaction, which is
+    committed (or rolled back on exception) when it exits. Nested blocks are savepoints, so exception caught
+    outside of a nested block rolls back only changes of that block.
+    """
+
     def __enter__(self):
-        self.conn = psycopg.connect(**connection_payload)
+        if getattr(_checkout, "conn", None) is None:
+            _checkout.conn = get_pool().getconn()
+            _checkout.depth = 0
+            _checkout.changes = []
+        _checkout.depth += 1
+
+        self.conn = _checkout.conn
+        try:
+            self.transaction = self.conn.transaction()
+            self.transaction.__enter__()
+        except BaseException:
+            self._release()
+            raise
         self.cur = self.conn.cursor()
 
         return self
 
-    def __exit__(self, exc_type, *_):
-        if exc_type:
-            self.conn.rollback()
-        else:
-            self.conn.commit()
-
+    def __exit__(self, exc_type, exc, tb):
         self.cur.close()
-        self.conn.close()
+        try:
+            self.transaction.__exit__(exc_type, exc, tb)
+        finally:
+            self._release()
+
+    @staticmethod
+    def _release() -> None:
+        """return connection to the pool when the outermost block exits.
+
+        Rows changed in the transaction are dropped from cache once more, whether it was committed or rolled back,
+        as concurrent reader could put the old row back before the transaction ended.
+        """
+
+        _checkout.depth -= 1
+        if _checkout.depth:
+            return
+
+        conn, _checkout.conn = _checkout.conn, None
+        changes, _checkout.changes = _checkout.changes, []
+        # broken connection is discarded by the pool and replaced with a new one
+        get_pool().putconn(conn)
+        for model, ids in changes:
+            if model.cache_ttl:
+                model_cache.discard(model, ids)
 
     def query(self, sql: str, params: tuple | None = None):
         self.cur.execute(sql, params or ())
         return self.cur.fetchall()
 
 
-@dataclass
-class User:
-    name: str
-    phone: str
-    role: str
-    id: int | None = None
+class ModelCache:
+    """Process-wide LRU cache of rows by (table, id), time to live of rows is set per model.
+
+    Rows are kept as tuples of values and every hit returns a new instance,
+    so changes of the instance by one caller are not seen by others.
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE):
+        self.max_size = max_size
+        self._rows: OrderedDict[tuple, tuple[float, tuple]] = OrderedDict()  # (table, id) -> (expires, values)
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, model: type["Model"], id: int):
+        key = (model.table, id)
+        with self._lock:
+            entry = self._rows.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._rows[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+        return model(*entry[1])
+
+    def put(self, instance: "Model") -> None:
+        model = type(instance)
+        key = (model.table, instance.id)
+        values = tuple(getattr(instance, column) for column in model.columns())
+        with self._lock:
+            self._rows[key] = (time.monotonic() + model.cache_ttl, values)
+            self._rows.move_to_end(key)
+            if len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, model: type["Model"], ids) -> None:
+        with self._lock:
+            for id in ids:
+                self._rows.pop((model.table, id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+model_cache = ModelCache()
+
+
+class IdentityMap:
+    """Instances loaded by id in current thread within the block, the same row is always the same instance.
+
+        with IdentityMap() as identity_map:
+            assert Dish.get(id=1) is Dish.get(id=1)
+        print(identity_map.hits, identity_map.misses)
+    """
+
+    def __init__(self):
+        self._instances: dict[tuple, "Model"] = {}
+        self.hits = self.misses = 0
 
-    @classmethod
-    def all(cls) -> list["User"]:
-        """return all the users from `users` table."""
+    def __enter__(self):
+        self._previous = getattr(_checkout, "identity_map", None)
+        _checkout.identity_map = self
+        return self
 
-        with DatabaseConnection() as db:
-            rows = db.query("SELECT name, phone, role, id FROM users")
-            return [cls(*row) for row in rows]
+    def __exit__(self, *_):
+        _checkout.identity_map = self._previous
 
-    @classmethod
-    def filter(cls, **filters) -> list["User"]:
-        """return filtered users from `users` table."""
+    @staticmethod
+    def current() -> "IdentityMap | None":
+        return getattr(_checkout, "identity_map", None)
 
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+    def get(self, model: type["Model"], id: int):
+        instance = self._instances.get((model, id))
+        if instance is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return instance
+
+    def add(self, instance: "Model") -> None:
+        self._instances[(type(instance), instance.id)] = instance
+
+    def discard(self, model: type["Model"], ids) -> None:
+        for id in ids:
+            self._instances.pop((model, id), None)
+
+
+def _changed(model: type["Model"], ids: list[int]) -> None:
+    """drop changed rows from cache now and once more when the transaction ends, see DatabaseConnection._release."""
+
+    _checkout.changes.append((model, ids))
+    if model.cache_ttl:
+        model_cache.discard(model, ids)
+
+
+def _uncommitted_changes() -> bool:
+    """whether current thread has changed rows in not yet committed transaction.
+
+    Its reads bypass model_cache: they could see its own uncommitted rows, which must not reach other threads.
+    """
+
+    return getattr(_checkout, "conn", None) is not None and bool(_checkout.changes)
+
+
+def _check_fields(model: type["Model"], keys: tuple[str, ...]) -> None:
+    unknown = set(keys) - set(model.columns())
+    if unknown:
+        raise ValueError(f"Unknown fields of {model.__name__}: {', '.join(sorted(unknown))}")
+
+
+@cache
+def _compile(model: type["Model"], operation: str, keys: tuple[str, ...] = ()) -> str:
+    """return SQL of operation for model, keys are fields of SET clause of update, column of `any` lookup
+    or fields of bulk update.
+
+    SQL is built once per (model, operation, keys), so the same string is sent to the server
+    and its prepared statement is reused by the connection.
+    """
+
+    _check_fields(model, keys)
+    table, columns = model.table, model.columns()
+
+    if operation == "insert":
+        insert_columns = columns[:-1]  # without id
+        placeholders = ", ".join(["%s"] * len(insert_columns))
+        return f"INSERT INTO {table} ({', '.join(insert_columns)}) VALUES ({placeholders}) RETURNING id"
+    if operation == "update":
+        assignments = ", ".join([f"{key} = %s" for key in keys])
+        return f"UPDATE {table} SET {assignments} WHERE id = %s RETURNING {', '.join(columns)}"
+    if operation == "delete":
+        return f"DELETE FROM {table} WHERE id = %s RETURNING id"
+    if operation == "insert_with_id":
+        placeholders = ", ".join(["%s"] * len(columns))
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    if operation == "any":
+        return f"SELECT {', '.join(columns)} FROM {table} WHERE {keys[0]} = ANY(%s)"
+    if operation == "next_ids":
+        return f"SELECT nextval(pg_get_serial_sequence('{table}', 'id')) FROM generate_series(1, %s)"
+    if operation == "copy":
+        return f"COPY {table} (id, {', '.join(columns[:-1])}) FROM STDIN"
+    # bulk update: rows are copied into temporary table and the table is updated from it by one statement
+    if operation == "bulk_table":
+        return f"CREATE TEMP TABLE bulk_{table} AS SELECT id, {', '.join(keys)} FROM {table} WITH NO DATA"
+    if operation == "bulk_copy":
+        return f"COPY bulk_{table} (id, {', '.join(keys)}) FROM STDIN"
+    if operation == "bulk_update":
+        assignments = ", ".join([f"{key} = bulk.{key}" for key in keys])
+        return f"UPDATE {table} SET {assignments} FROM bulk_{table} AS bulk WHERE {table}.id = bulk.id"
+    if operation == "bulk_drop":
+        return f"DROP TABLE bulk_{table}"
+    raise ValueError(f"Unknown operation: {operation}")
+
+
+def _fetch_any(model: type["Model"], column: str, values) -> list:
+    """return rows of model with column value in values by one query."""
+
+    with DatabaseConnection() as db:
+        db.cur.row_factory = model._row_factory
+        db.cur.execute(_compile(model, "any", (column,)), (list(values),), prepare=True)
+        return db.cur.fetchall()
+
+
+def _stream(sql: str, params: tuple, row_factory, batch_size: int = BATCH_SIZE) -> Iterator:
+    """yield rows of query through server-side cursor, fetching batch_size rows at once."""
+
+    with DatabaseConnection() as db:
+        with db.conn.cursor(name=f"cursor_{next(_cursor_numbers)}", row_factory=row_factory) as cur:
+            cur.itersize = batch_size
+            cur.execute(sql, params)
+            try:
+                yield from cur
+            except GeneratorExit:
+                # iteration stopped early is not an error, so transaction is not rolled back
+                return
 
-        with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT name, phone, role, id FROM users WHERE {conditions}",
-                values,
-            )
-            return [cls(*row) for row in rows]
 
-    @classmethod
-    def get(cls, **filters) -> "User":
-        """return filtered users from `users` table."""
+def _where(table: str, filters: dict, conditions: list[str] | None = None) -> tuple[str, tuple]:
+    """return WHERE clause for filters on table columns and extra conditions, and its parameters."""
 
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+    keys = tuple(sorted(filters))
+    conditions = [f"{table}.{key} = %s" for key in keys] + (conditions or [])
+    return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), tuple(filters[key] for key in keys)
 
-        with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT name, phone, role, id FROM users WHERE {conditions}",
-                values,
-            )
-            try:
-                name, phone, role, id = rows[0]
-            except IndexError:
-                return []
 
-            return cls(id=id, name=name, phone=phone, role=role)
+class ForeignKey:
+    """Related object referenced by `<name>_id` field, loaded on first access.
 
-    def create(self) -> "User":
-        with DatabaseConnection() as db:
-            db.cur.execute(
-                "INSERT INTO users (name, phone, role) VALUES (%s, %s, %s) RETURNING id",
-                (self.name, self.phone, self.role),
-            )
-            # NOTE: actually bad practice to mutate `self` instance from here
+        @dataclass
+        class Order(Model, table="orders"):
+            user_id: int
+            id: int | None = None
 
-            self.id = db.cur.fetchone()[0]
+            user = ForeignKey("User")
+
+    Loaded object is kept in instance __dict__, so next access does not reach the descriptor.
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+        self.column = f"{name}_id"
 
+    def related_model(self, owner: type["Model"]) -> type["Model"]:
+        """return related model from the module of owner, so subclasses of models in other module use their own."""
+
+        return _models[owner.__module__, self.model_name]
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
             return self
+        _check_lazy_loading(type(instance), self.name)
+        related = self.related_model(type(instance)).get(id=getattr(instance, self.column))
+        instance.__dict__[self.name] = related
+        return related
 
-    def update(self, **payload) -> "User | None":
-        fields = ", ".join([f"{key} = %s" for key in payload])
-        values = tuple(payload.values())
+    def related_objects(self, instance) -> list:
+        related = getattr(instance, self.name)
+        return [] if related is None else [related]
 
-        # ensure id exists
-        if self.id is None:
-            raise ValueError("Can not update user without ID")
+    def prefetch(self, instances: list) -> None:
+        model = self.related_model(type(instances[0]))
+        related = model.get_many(getattr(instance, self.column) for instance in instances)
+        for instance in instances:
+            instance.__dict__[self.name] = related.get(getattr(instance, self.column))
 
-        with DatabaseConnection() as db:
-            db.cur.execute(
-                f"UPDATE users SET {fields} WHERE id = %s RETURNING id, name, phone, role",
-                (*values, self.id),
-            )
 
-            row = db.cur.fetchone()
+class RelatedList:
+    """List of objects, which reference instance by given field, loaded on first access.
 
-        if not row:
-            return None
-        else:
-            _, name, phone, role = row
-            self.name = name
-            self.phone = phone
-            self.role = role
+        items = RelatedList("OrderItem", "order_id")
+    """
+
+    def __init__(self, model_name: str, column: str):
+        self.model_name = model_name
+        self.column = column
 
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    related_model = ForeignKey.related_model
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
             return self
+        _check_lazy_loading(type(instance), self.name)
+        related = list(self.related_model(type(instance)).filter(**{self.column: instance.id}))
+        instance.__dict__[self.name] = related
+        return related
 
-    @classmethod
-    def delete(cls, id: int) -> bool:
+    def related_objects(self, instance) -> list:
+        return getattr(instance, self.name)
+
+    def prefetch(self, instances: list) -> None:
+        related = defaultdict(list)
+        model = self.related_model(type(instances[0]))
+        for obj in _fetch_any(model, self.column, {instance.id for instance in instances}):
+            related[getattr(obj, self.column)].append(obj)
+        for instance in instances:
+            instance.__dict__[self.name] = related.get(instance.id, [])
+
+
+def _check_lazy_loading(model: type["Model"], name: str) -> None:
+    if not model.lazy_relations:
+        raise AttributeError(f"{model.__name__}.{name} is not loaded, use select_related or prefetch_related")
+
+
+def _relation(model: type["Model"], name: str) -> ForeignKey | RelatedList:
+    relation = getattr(model, name, None)
+    if not isinstance(relation, (ForeignKey, RelatedList)):
+        raise ValueError(f"Unknown relation of {model.__name__}: {name}")
+    return relation
+
+
+@cache
+def _foreign_keys(model: type["Model"]) -> list[ForeignKey]:
+    return [value for value in (getattr(model, name) for name in dir(model)) if isinstance(value, ForeignKey)]
+
+
+def _dependencies(model: type["Model"]) -> set[type["Model"]]:
+    """models referenced by foreign keys of model, their rows have to be inserted first."""
+
+    return {relation.related_model(model) for relation in _foreign_keys(model)}
+
+
+def _prefetch(instances: list, lookup: str) -> None:
+    """load relation for all instances with one query, lookup is a relation name or path like "items__dish"."""
+
+    if not instances:
+        return
+    name, _, rest = lookup.partition("__")
+    relation = _relation(type(instances[0]), name)
+
+    not_loaded = [instance for instance in instances if name not in instance.__dict__]
+    if not_loaded:
+        relation.prefetch(not_loaded)
+    if rest:
+        _prefetch([obj for instance in instances for obj in relation.related_objects(instance)], rest)
+
+
+@cache
+def _joined_row_factory(model: type["Model"], related: tuple[str, ...]):
+    """return row factory for select_related query: columns of model are followed by columns of related models."""
+
+    joins = [(name, _relation(model, name).related_model(model)) for name in related]
+    size = len(model.columns())
+
+    def row_factory(cursor):
+        def make_row(values):
+            instance = model(*values[:size])
+            start = size
+            for name, related_model in joins:
+                end = start + len(related_model.columns())
+                # id is the last column, it is NULL if there is no related row
+                instance.__dict__[name] = related_model(*values[start:end]) if values[end - 1] is not None else None
+                start = end
+            return instance
+
+        return make_row
+
+    return row_factory
+
+
+@cache
+def _compile_query(
+    model: type["Model"],
+    filter_keys: tuple[str, ...],
+    exclude_keys: tuple[tuple[str, ...], ...],
+    ordering: tuple[str, ...],
+    value_fields: tuple[str, ...],
+    related: tuple[str, ...],
+    has_limit: bool,
+    has_offset: bool,
+    wrap: str = "",
+) -> str:
+    """return SELECT for structure of QuerySet, filter values, limit and offset are passed as parameters.
+
+    related are foreign keys joined to the query, wrap is "count" or "exists"
+    to return the number of rows or whether there are any.
+    """
+
+    ordering_fields = tuple(field.removeprefix("-") for field in ordering)
+    _check_fields(model, filter_keys + sum(exclude_keys, ()) + ordering_fields + value_fields)
+    table = model.table
+
+    conditions = [f"{table}.{key} = %s" for key in filter_keys]
+    conditions += ["NOT (" + " AND ".join([f"{table}.{key} = %s" for key in keys]) + ")" for keys in exclude_keys]
+
+    columns = [f"{table}.{column}" for column in value_fields or model.columns()]
+    joins = []
+    for name in related:
+        relation = _relation(model, name)
+        related_model = relation.related_model(model)
+        # related table is aliased by relation name, so the same table can be joined twice
+        columns += [f'"{name}".{column}' for column in related_model.columns()]
+        joins.append(f' LEFT JOIN {related_model.table} AS "{name}" ON "{name}".id = {table}.{relation.column}')
+
+    sql = f"SELECT {', '.join(columns)} FROM {table}{''.join(joins)}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    if ordering:
+        sql += " ORDER BY " + ", ".join(
+            [f"{table}.{field[1:]} DESC" if field[0] == "-" else f"{table}.{field}" for field in ordering]
+        )
+    if has_limit:
+        sql += " LIMIT %s"
+    if has_offset:
+        sql += " OFFSET %s"
+
+    if wrap == "count":
+        return f"SELECT count(*) FROM ({sql}) AS query"
+    if wrap == "exists":
+        return f"SELECT EXISTS ({sql})"
+    return sql
+
+
+@dataclass(frozen=True)
+class QuerySet:
+    """Lazy query of model rows.
+
+    SQL is executed only when queryset is iterated, counted or checked for existence,
+    every other method returns a new queryset, so they can be chained:
+
+        Order.filter(status="PENDING").exclude(user_id=4).order_by("-date").limit(10)
+
+    Rows are streamed through server-side cursor in batches, so iteration over
+    the whole table does not keep all the rows in memory.
+
+    Related objects are loaded with the rows either by JOIN (select_related, for foreign keys)
+    or by one query per relation for every batch of rows (prefetch_related), e.g. orders with
+    their users, items and dishes of items take two queries per batch:
+
+        Order.all().select_related("user").prefetch_related("items__dish")
+    """
+
+    model: type["Model"]
+    filters: tuple[tuple[str, Any], ...] = ()
+    excludes: tuple[tuple[tuple[str, Any], ...], ...] = ()
+    ordering: tuple[str, ...] = ()
+    value_fields: tuple[str, ...] = ()
+    limit_value: int | None = None
+    offset_value: int | None = None
+    related: tuple[str, ...] = ()
+    prefetch: tuple[str, ...] = ()
+
+    def filter(self, **filters) -> "QuerySet":
+        return replace(self, filters=self.filters + tuple(sorted(filters.items())))
+
+    def exclude(self, **filters) -> "QuerySet":
+        """exclude rows which match all the given values."""
+
+        if not filters:
+            return self
+        return replace(self, excludes=self.excludes + (tuple(sorted(filters.items())),))
+
+    def order_by(self, *fields: str) -> "QuerySet":
+        """order by given fields, "-" before field name means descending order."""
+
+        return replace(self, ordering=fields)
+
+    def limit(self, number: int) -> "QuerySet":
+        return replace(self, limit_value=number)
+
+    def offset(self, number: int) -> "QuerySet":
+        return replace(self, offset_value=number)
+
+    def values(self, *fields: str) -> "QuerySet":
+        """return rows as dicts of given fields (all if not given) instead of model instances."""
+
+        return replace(self, value_fields=fields or self.model.columns())
+
+    def select_related(self, *names: str) -> "QuerySet":
+        """join objects of given foreign keys to the query."""
+
+        for name in names:
+            if not isinstance(_relation(self.model, name), ForeignKey):
+                raise ValueError(f"{self.model.__name__}.{name} is not a foreign key, use prefetch_related")
+        return replace(self, related=self.related + names)
+
+    def prefetch_related(self, *lookups: str) -> "QuerySet":
+        """load given relations of rows by one query per relation for every batch of rows.
+
+        lookup is a relation name or path of relations separated by "__", e.g. "items__dish".
+        """
+
+        return replace(self, prefetch=self.prefetch + lookups)
+
+    def _query(self, wrap: str = "") -> tuple[str, tuple]:
+        sql = _compile_query(
+            self.model,
+            tuple(key for key, _ in self.filters),
+            tuple(tuple(key for key, _ in exclude) for exclude in self.excludes),
+            self.ordering,
+            self.value_fields,
+            () if self.value_fields else self.related,
+            self.limit_value is not None,
+            self.offset_value is not None,
+            wrap,
+        )
+        params = [value for _, value in self.filters]
+        params += [value for exclude in self.excludes for _, value in exclude]
+        params += [number for number in (self.limit_value, self.offset_value) if number is not None]
+        return sql, tuple(params)
+
+    def _scalar(self, wrap: str):
+        sql, params = self._query(wrap)
         with DatabaseConnection() as db:
-            db.cur.execute("DELETE FROM users WHERE id = %s RETURNING id", (id,))
-            return db.cur.fetchone() is not None
+            db.cur.execute(sql, params, prepare=True)
+            return db.cur.fetchone()[0]
+
+    def iterator(self, batch_size: int = BATCH_SIZE) -> Iterator:
+        """yield rows fetched by batch_size at once."""
+
+        rows = self._rows(batch_size)
+        if not self.prefetch or self.value_fields:
+            return rows
+        return self._prefetched(rows, batch_size)
+
+    def _prefetched(self, rows: Iterator, batch_size: int) -> Iterator:
+        try:
+            while batch := list(islice(rows, batch_size)):
+                for lookup in self.prefetch:
+                    _prefetch(batch, lookup)
+                yield from batch
+        finally:
+            rows.close()
+
+    def _rows(self, batch_size: int) -> Iterator:
+        sql, params = self._query()
+        if self.value_fields:
+            row_factory = dict_row
+        elif self.related:
+            row_factory = _joined_row_factory(self.model, self.related)
+        else:
+            row_factory = self.model._row_factory
 
+        if self.limit_value is not None and self.limit_value <= batch_size:
+            # the result fits one batch, so it is fetched with prepared statement instead of cursor
+            with DatabaseConnection() as db:
+                db.cur.row_factory = row_factory
+                db.cur.execute(sql, params, prepare=True)
+                rows = db.cur.fetchall()
+            yield from rows
+            return
 
-@dataclass
-class Dish:
-    name: str
-    price: float
-    id: int | None = None
+        yield from _stream(sql, params, row_factory, batch_size)
+
+    def __iter__(self) -> Iterator:
+        return self.iterator()
+
+    def first(self):
+        """return first row or None."""
+
+        return next(iter(self.limit(1)), None)
+
+    def count(self) -> int:
+        query = replace(self, related=())  # left joins do not change the number of rows
+        if self.limit_value is None and self.offset_value is None:
+            query = replace(query, ordering=())  # neither does the order
+        return query._scalar("count")
+
+    def exists(self) -> bool:
+        return replace(self, ordering=(), related=())._scalar("exists")
+
+
+class Model:
+    """Base of table models.
+
+    Subclass is a dataclass with `id` as the last field, table name is given in class definition:
+
+        @dataclass
+        class User(Model, table="users"):
+            name: str
+            id: int | None = None
+
+    Columns are the dataclass fields, rows are selected in the order of fields
+    and passed to the constructor as positional arguments. Relations are declared
+    with ForeignKey and RelatedList descriptors, they are not dataclass fields.
+
+    Lookups by id go through IdentityMap of current block and through model_cache,
+    if the model sets `cache_ttl` in seconds in class definition.
+    """
+
+    table: ClassVar[str]
+    cache_ttl: ClassVar[float | None]
+    lazy_relations: ClassVar[bool] = True  # whether not loaded relation is selected on access
+    indexes: ClassVar[tuple[tuple[str, ...], ...]] = ()  # columns of indexes besides foreign keys
+    constraints: ClassVar[tuple[str, ...]] = ()  # table constraints like "UNIQUE (phone)", used by migrations
+    id: int | None
+
+    def __init_subclass__(cls, table: str, cache_ttl: float | None = None, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.table = table
+        cls.cache_ttl = cache_ttl
+        cls._row_factory = staticmethod(args_row(cls))
+        _models[cls.__module__, cls.__name__] = cls
 
     @classmethod
-    def all(cls) -> list["Dish"]:
-        with DatabaseConnection() as db:
-            rows = db.query("SELECT name, price, id FROM dishes")
-            return [cls(*row) for row in rows]
+    def columns(cls) -> tuple[str, ...]:
+        # dataclass fields are known only after the decorator, so they are read on first use
+        if "_columns" not in cls.__dict__:
+            cls._columns = tuple(field.name for field in fields(cls))
+        return cls._columns
 
     @classmethod
-    def filter(cls, **filters) -> list["Dish"]:
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+    def all(cls) -> QuerySet:
+        """return lazy query of all rows of model table."""
 
-        with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT name, price, id FROM dishes WHERE {conditions}",
-                values,
-            )
-            return [cls(*row) for row in rows]
+        return QuerySet(cls)
 
     @classmethod
-    def get(cls, **filters) -> "Dish":
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+    def filter(cls, **filters) -> QuerySet:
+        """return lazy query of rows with fields equal to given values."""
 
-        with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT name, price, id FROM dishes WHERE {conditions}",
-                values,
-            )
-            name, price, id = rows[0]  # TODO: what if several items will be returned?
-            return cls(name=name, price=price, id=id)
+        return QuerySet(cls).filter(**filters)
+
+    @classmethod
+    def exclude(cls, **filters) -> QuerySet:
+        return QuerySet(cls).exclude(**filters)
+
+    @classmethod
+    def get(cls, **filters) -> Self | None:
+        """return first row with fields equal to given values or None."""
+
+        if filters.keys() == {"id"}:
+            return cls.get_many([filters["id"]]).get(filters["id"])
+        return QuerySet(cls).filter(**filters).first()
 
-    def create(self) -> "Dish":
+    @classmethod
+    def get_many(cls, ids) -> dict[int, Self]:
+        """return instances by ids, rows not found in identity map and cache are selected by one query."""
+
+        identity_map = IdentityMap.current()
+        cached = cls.cache_ttl and not _uncommitted_changes()
+        found, missing = {}, []
+        for id in set(ids) - {None}:
+            instance = identity_map.get(cls, id) if identity_map else None
+            if instance is None and cached:
+                instance = model_cache.get(cls, id)
+                if instance is not None and identity_map:
+                    identity_map.add(instance)
+            if instance is None:
+                missing.append(id)
+            else:
+                found[id] = instance
+
+        if missing:
+            for instance in _fetch_any(cls, "id", missing):
+                found[instance.id] = instance
+                if cached:
+                    model_cache.put(instance)
+                if identity_map:
+                    identity_map.add(instance)
+        return found
+
+    def create(self) -> Self:
+        values = tuple(getattr(self, column) for column in self.columns()[:-1])
         with DatabaseConnection() as db:
-            db.cur.execute(
-                "INSERT INTO dishes (name, price) VALUES (%s, %s) RETURNING id",
-                (self.name, self.price),
-            )
+            db.cur.execute(_compile(type(self), "insert"), values, prepare=True)
+            # NOTE: actually bad practice to mutate `self` instance from here
             self.id = db.cur.fetchone()[0]
+            _changed(type(self), [self.id])
+
+        if identity_map := IdentityMap.current():
+            identity_map.add(self)
         return self
 
-    def update(self, **payload) -> "Dish | None":
-        fields = ", ".join([f"{key} = %s" for key in payload])
-        values = tuple(payload.values())
+    def update(self, **payload) -> Self | None:
+        # ensure id exists
         if self.id is None:
-            raise ValueError("Can not update dish without ID")
+            raise ValueError(f"Can not update {type(self).__name__} without ID")
+
+        keys = tuple(sorted(payload))
         with DatabaseConnection() as db:
             db.cur.execute(
-                f"UPDATE dishes SET {fields} WHERE id = %s RETURNING id, name, price",
-                (*values, self.id),
+                _compile(type(self), "update", keys),
+                (*(payload[key] for key in keys), self.id),
+                prepare=True,
             )
             row = db.cur.fetchone()
+            _changed(type(self), [self.id])
+
         if not row:
             return None
-        else:
-            _, name, price = row
-            self.name, self.price = name, price
-            return self
+        for column, value in zip(self.columns(), row):
+            setattr(self, column, value)
+        return self
 
     @classmethod
     def delete(cls, id: int) -> bool:
         with DatabaseConnection() as db:
-            db.cur.execute("DELETE FROM dishes WHERE id = %s RETURNING id", (id,))
-            return db.cur.fetchone() is not None
+            db.cur.execute(_compile(cls, "delete"), (id,), prepare=True)
+            _changed(cls, [id])
+            deleted = db.cur.fetchone() is not None
 
-
-@dataclass
-class Order:
-    date: date
-    total: float
-    status: str
-    user_id: int
-    id: int | None = None
+        if identity_map := IdentityMap.current():
+            identity_map.discard(cls, [id])
+        return deleted
 
     @classmethod
-    def all(cls) -> list["Order"]:
-        with DatabaseConnection() as db:
-            rows = db.query("SELECT date, total, status, user_id, id FROM orders")
-            return [cls(*row) for row in rows]
+    def bulk_create(cls, instances: list[Self]) -> list[Self]:
+        """insert instances with COPY, ids for new rows are taken from table sequence beforehand."""
 
-    @classmethod
-    def filter(cls, **filters) -> list["Order"]:
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+        columns = cls.columns()[:-1]
+        new = [instance for instance in instances if instance.id is None]
 
         with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT date, total, status, user_id, id FROM orders WHERE {conditions}",
-                values,
-            )
-            return [cls(*row) for row in rows]
+            db.cur.execute(_compile(cls, "next_ids"), (len(new),))
+            new_ids = iter([row[0] for row in db.cur.fetchall()])
+            ids = [next(new_ids) if instance.id is None else instance.id for instance in instances]
+
+            with db.cur.copy(_compile(cls, "copy")) as copy:
+                for id, instance in zip(ids, instances):
+                    copy.write_row((id, *(getattr(instance, column) for column in columns)))
+            if len(instances) >= ANALYZE_THRESHOLD:
+                # planner statistics of freshly loaded table are stale until autovacuum gets to it,
+                # so joins and aggregates over it could get nested loops over millions of rows
+                db.cur.execute(f"ANALYZE {cls.table}")
+            _changed(cls, ids)
+
+        for id, instance in zip(ids, instances):
+            instance.id = id
+        return instances
 
     @classmethod
-    def get(cls, **filters) -> "Order":
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+    def bulk_update(cls, instances: list[Self], fields: list[str]) -> int:
+        """update given fields of instances with one statement, rows are loaded with COPY into temporary table.
 
-        with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT date, total, status, user_id, id FROM orders WHERE {conditions}",
-                values,
-            )
-            date_val, total, status, user_id, id = rows[0]
-            return cls(
-                date=date_val, total=total, status=status, user_id=user_id, id=id
-            )
+        return number of updated rows.
+        """
 
-    def create(self) -> "Order":
-        with DatabaseConnection() as db:
-            db.cur.execute(
-                "INSERT INTO orders (date, total, status, user_id) VALUES (%s, %s, %s, %s) RETURNING id",
-                (self.date, self.total, self.status, self.user_id),
-            )
-            self.id = db.cur.fetchone()[0]
-        return self
+        fields = tuple(fields)
+        _check_fields(cls, fields)
+        if any(instance.id is None for instance in instances):
+            raise ValueError(f"Can not update {cls.__name__} without ID")
 
-    def update(self, **payload) -> "Order | None":
-        fields = ", ".join([f"{key} = %s" for key in payload])
-        values = tuple(payload.values())
-        if self.id is None:
-            raise ValueError("Can not update order without ID")
         with DatabaseConnection() as db:
-            db.cur.execute(
-                f"UPDATE orders SET {fields} WHERE id = %s RETURNING id, date, total, status, user_id",
-                (*values, self.id),
-            )
-            row = db.cur.fetchone()
-        if not row:
-            return None
+            db.cur.execute(_compile(cls, "bulk_table", fields))
+            with db.cur.copy(_compile(cls, "bulk_copy", fields)) as copy:
+                for instance in instances:
+                    copy.write_row((instance.id, *(getattr(instance, field) for field in fields)))
+            db.cur.execute(_compile(cls, "bulk_update", fields))
+            updated = db.cur.rowcount
+            db.cur.execute(_compile(cls, "bulk_drop"))
+            _changed(cls, [instance.id for instance in instances])
+        return updated
+
+
+class Session:
+    """Unit of work: changes are collected by the session and flushed together.
+
+    New instances get ids reserved from table sequences by one query, then all
+    inserts, updates and deletes are sent in one pipeline in order of foreign keys.
+    Foreign keys are resolved from related instances, which may be new as well:
+
+        with transaction() as session:
+            order = session.add(Order(date.today(), 154.5, "PENDING", user.id))
+            session.add(OrderItem(None, dish.id, 2), order=order)
+    """
+
+    def __init__(self):
+        self._new: list[Model] = []
+        self._dirty: dict[int, tuple[Model, set[str]]] = {}  # by id() of instance
+        self._deleted: list[Model] = []
+
+    def add(self, instance: Model, **related: Model) -> Model:
+        """insert new instance or update all fields of existing one, related are objects of its foreign keys."""
+
+        for name, obj in related.items():
+            if not isinstance(_relation(type(instance), name), ForeignKey):
+                raise ValueError(f"{type(instance).__name__}.{name} is not a foreign key")
+            instance.__dict__[name] = obj
+
+        if instance.id is None:
+            self._new.append(instance)
         else:
-            _, date_val, total, status, user_id = row
-            self.date, self.total, self.status, self.user_id = (
-                date_val,
-                total,
-                status,
-                user_id,
-            )
-            return self
+            self._mark_dirty(instance, instance.columns()[:-1])
+        return instance
+
+    def update(self, instance: Model, **payload) -> Model:
+        _check_fields(type(instance), tuple(payload))
+        for key, value in payload.items():
+            setattr(instance, key, value)
+        if instance.id is not None:
+            self._mark_dirty(instance, payload)
+        return instance
+
+    def delete(self, instance: Model) -> None:
+        if instance.id is None:
+            self._new.remove(instance)
+        else:
+            self._dirty.pop(id(instance), None)
+            self._deleted.append(instance)
+
+    def _mark_dirty(self, instance: Model, fields) -> None:
+        _, dirty_fields = self._dirty.setdefault(id(instance), (instance, set()))
+        dirty_fields.update(fields)
+
+    def flush(self) -> None:
+        """send pending changes to the database, they are committed with the transaction."""
+
+        new, dirty, deleted = self._new, list(self._dirty.values()), self._deleted
+        self._new, self._dirty, self._deleted = [], {}, []
+        models = {type(instance) for instance in new + deleted} | {type(instance) for instance, _ in dirty}
+        order = list(TopologicalSorter({model: _dependencies(model) & models for model in models}).static_order())
 
-    @classmethod
-    def delete(cls, id: int) -> bool:
         with DatabaseConnection() as db:
-            db.cur.execute("DELETE FROM orders WHERE id = %s RETURNING id", (id,))
-            return db.cur.fetchone() is not None
+            self._reserve_ids(db, new)
+            for instance in new:
+                self._resolve_foreign_keys(instance)
+            for instance, fields in dirty:
+                fields.update(self._resolve_foreign_keys(instance))
+
+            with db.conn.pipeline():
+                for model in order:
+                    rows = [instance for instance in new if type(instance) is model]
+                    if rows:
+                        db.cur.executemany(
+                            _compile(model, "insert_with_id"),
+                            [tuple(getattr(instance, column) for column in model.columns()) for instance in rows],
+                        )
+                    updates = defaultdict(list)
+                    for instance, fields in dirty:
+                        if type(instance) is model:
+                            keys = tuple(sorted(fields))
+                            updates[keys].append((*(getattr(instance, key) for key in keys), instance.id))
+                    for keys, params in updates.items():
+                        db.cur.executemany(_compile(model, "update", keys), params)
+
+                for model in reversed(order):
+                    ids = [(instance.id,) for instance in deleted if type(instance) is model]
+                    if ids:
+                        db.cur.executemany(_compile(model, "delete"), ids)
+
+            for model in order:
+                ids = [instance.id for instance in new + deleted if type(instance) is model]
+                ids += [instance.id for instance, _ in dirty if type(instance) is model]
+                _changed(model, ids)
+
+        if identity_map := IdentityMap.current():
+            for instance in new:
+                identity_map.add(instance)
+            for instance in deleted:
+                identity_map.discard(type(instance), [instance.id])
+
+    @staticmethod
+    def _reserve_ids(db: DatabaseConnection, instances: list[Model]) -> None:
+        counts = defaultdict(int)
+        for instance in instances:
+            counts[type(instance)] += 1
+        if not counts:
+            return
+
+        parts = ["SELECT %s, nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)"] * len(counts)
+        params = [param for model, number in counts.items() for param in (model.table, model.table, number)]
+        db.cur.execute(" UNION ALL ".join(parts), params)
+        ids = defaultdict(list)
+        for table, id in db.cur.fetchall():
+            ids[table].append(id)
+        next_ids = {table: iter(sorted(table_ids)) for table, table_ids in ids.items()}
+        for instance in instances:
+            instance.id = next(next_ids[instance.table])
+
+    @staticmethod
+    def _resolve_foreign_keys(instance: Model) -> list[str]:
+        """set `<name>_id` fields from related objects, return names of changed fields."""
+
+        changed = []
+        for relation in _foreign_keys(type(instance)):
+            related = instance.__dict__.get(relation.name)
+            if related is not None and getattr(instance, relation.column) != related.id:
+                setattr(instance, relation.column, related.id)
+                changed.append(relation.column)
+        return changed
+
+
+@contextmanager
+def transaction() -> Iterator[Session]:
+    """unit of work: session changes are flushed and committed once when the block exits.
+
+    All ORM calls inside the block use the same connection and transaction,
+    and lookups by id go through the identity map of the block.
+    """
+
+    with DatabaseConnection(), IdentityMap():
+        session = Session()
+        yield session
+        session.flush()
+
+
+def index_columns(model: type[Model]) -> list[tuple[str, ...]]:
+    """columns of model indexes: every foreign key and declared `indexes`."""
+
+    return [(relation.column,) for relation in _foreign_keys(model)] + list(model.indexes)
+
+
+def create_indexes(models: list[type[Model]] | None = None) -> list[str]:
+    """create missing indexes of models (all models of this module by default), return names of indexes."""
+
+    models = models or [model for (module, _), model in _models.items() if module == __name__]
+    names = []
+    with DatabaseConnection() as db:
+        for model in models:
+            for columns in index_columns(model):
+                name = f"{model.table}_{'_'.join(columns)}_idx"
+                db.cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {model.table} ({', '.join(columns)})")
+                names.append(name)
+    return names
 
 
 @dataclass
-class OrderItem:
-    order_id: int
-    dish_id: int
-    quantity: int
+class User(Model, table="users", cache_ttl=30):
+    name: str
+    phone: str
+    role: str
+    id: int | None = None
+
+    constraints = ("UNIQUE (phone)", "CHECK (role IN ('ADMIN', 'USER', 'SUPPORT'))")
+
+    orders = RelatedList("Order", "user_id")
+
+
+@dataclass
+class Dish(Model, table="dishes", cache_ttl=300):
+    name: str
+    price: float
     id: int | None = None
 
+    constraints = ("CHECK (price >= 0)",)
+
     @classmethod
-    def all(cls) -> list["OrderItem"]:
+    def top_sellers(cls, n: int = 10) -> list[tuple["Dish", int]]:
+        """return n dishes with the biggest quantity in order items and their quantities."""
+
         with DatabaseConnection() as db:
-            rows = db.query("SELECT order_id, dish_id, quantity, id FROM order_items")
-            return [cls(*row) for row in rows]
+            db.cur.row_factory = cls._top_sellers_row_factory
+            db.cur.execute(cls._top_sellers_sql(), (n,), prepare=True)
+            return db.cur.fetchall()
 
     @classmethod
-    def filter(cls, **filters) -> list["OrderItem"]:
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+    def _top_sellers_sql(cls) -> str:
+        columns = ", ".join([f"dishes.{column}" for column in cls.columns()])
+        return (
+            f"SELECT {columns}, SUM(order_items.quantity) AS sold FROM order_items"
+            " JOIN dishes ON dishes.id = order_items.dish_id"
+            " GROUP BY dishes.id ORDER BY sold DESC LIMIT %s"
+        )
 
-        with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT order_id, dish_id, quantity, id FROM order_items WHERE {conditions}",
-                values,
-            )
-            return [cls(*row) for row in rows]
+    @classmethod
+    def _top_sellers_row_factory(cls, cursor):
+        size = len(cls.columns())
+        return lambda values: (cls(*values[:size]), values[size])
+
+
+@dataclass
+class Order(Model, table="orders"):
+    date: date
+    total: float
+    status: str
+    user_id: int
+    id: int | None = None
+
+    user = ForeignKey("User")
+    items = RelatedList("OrderItem", "order_id")
+
+    indexes = (("date",),)
+    constraints = ("CHECK (total >= 0)", "CHECK (status IN ('PENDING', 'PROCESSING', 'DELIVERED'))")
+
+    # revenue is calculated from current prices of dishes, as order items do not keep the price
+    _REVENUE = "SUM(order_items.quantity * dishes.price)"
+    _ITEMS_JOIN = (
+        " JOIN order_items ON order_items.order_id = orders.id"
+        " JOIN dishes ON dishes.id = order_items.dish_id"
+    )
 
     @classmethod
-    def get(cls, **filters) -> "OrderItem":
-        keys = filters.keys()
-        conditions = " AND ".join([f"{key} = %s" for key in keys])
-        values = tuple(filters.values())
+    def with_totals(cls, **filters) -> Iterator["Order"]:
+        """yield orders with `total` calculated from their items by one grouped query.
 
-        with DatabaseConnection() as db:
-            rows = db.query(
-                f"SELECT order_id, dish_id, quantity, id FROM order_items WHERE {conditions}",
-                values,
-            )
-            order_id, dish_id, quantity, id = rows[0]
-            return cls(
-                order_id=order_id, dish_id=dish_id, quantity=quantity, id=id
-            )
+        Orders are streamed through server-side cursor, orders without items have zero total.
+        """
 
-    def create(self) -> "OrderItem":
-        with DatabaseConnection() as db:
-            db.cur.execute(
-                "INSERT INTO order_items (order_id, dish_id, quantity) VALUES (%s, %s, %s) RETURNING id",
-                (self.order_id, self.dish_id, self.quantity),
-            )
-            self.id = db.cur.fetchone()[0]
-        return self
+        return _stream(*cls._with_totals_query(filters), cls._row_factory)
+
+    @classmethod
+    def update_totals(cls) -> int:
+        """set stored `total` of orders to the sum of their items, return number of changed orders."""
 
-    def update(self, **payload) -> "OrderItem | None":
-        fields = ", ".join([f"{key} = %s" for key in payload])
-        values = tuple(payload.values())
-        if self.id is None:
-            raise ValueError("Can not update order item without ID")
         with DatabaseConnection() as db:
-            db.cur.execute(
-                f"UPDATE orders SET {fields} WHERE id = %s RETURNING id, order_id, dish_id, quantity",
-                (*values, self.id),
-            )
-            row = db.cur.fetchone()
-        if not row:
-            return None
-        else:
-            _, order_id, dish_id, quantity = row
-            self.order_id, self.dish_id, self.quantity = (
-                order_id,
-                dish_id,
-                quantity
-            )
-            return self
+            db.cur.execute(cls._update_totals_sql())
+            return db.cur.rowcount
 
     @classmethod
-    def delete(cls, id: int) -> bool:
+    def revenue_by_day(cls, start: date | None = None, end: date | None = None, **filters) -> list[tuple[date, float]]:
+        """return (date, revenue) of orders from start to end inclusive, filters are fields of orders."""
+
+        return cls._aggregate(*cls._revenue_by_day_query(start, end, filters))
+
+    @classmethod
+    def revenue_by_user(cls, n: int | None = None, **filters) -> list[tuple[int, float]]:
+        """return (user_id, revenue) of n users with the biggest revenue (all if n is None)."""
+
+        return cls._aggregate(*cls._revenue_by_user_query(n, filters))
+
+    # SQL of the methods above is built separately, so async_orm.Order runs the same queries
+
+    @classmethod
+    def _with_totals_query(cls, filters: dict) -> tuple[str, tuple]:
+        _check_fields(cls, tuple(filters))
+        columns = ", ".join(
+            [f"COALESCE({cls._REVENUE}, 0)" if column == "total" else f"orders.{column}" for column in cls.columns()]
+        )
+        where, params = _where(cls.table, filters)
+        sql = (
+            f"SELECT {columns} FROM orders{cls._ITEMS_JOIN.replace(' JOIN', ' LEFT JOIN')}{where}"
+            " GROUP BY orders.id ORDER BY orders.id"
+        )
+        return sql, params
+
+    @classmethod
+    def _update_totals_sql(cls) -> str:
+        # orders without items get zero total, as in with_totals
+        return (
+            f"UPDATE orders SET total = totals.total FROM (SELECT orders.id, COALESCE({cls._REVENUE}, 0) AS total"
+            f" FROM orders{cls._ITEMS_JOIN.replace(' JOIN', ' LEFT JOIN')} GROUP BY orders.id) AS totals"
+            " WHERE orders.id = totals.id AND orders.total IS DISTINCT FROM totals.total"
+        )
+
+    @classmethod
+    def _revenue_by_day_query(cls, start: date | None, end: date | None, filters: dict) -> tuple[str, tuple]:
+        _check_fields(cls, tuple(filters))
+        bounds = [condition for condition, bound in (("orders.date >= %s", start), ("orders.date <= %s", end)) if bound]
+        where, params = _where(cls.table, filters, bounds)
+        params += tuple(bound for bound in (start, end) if bound)
+        sql = f"SELECT orders.date, {cls._REVENUE} FROM orders{cls._ITEMS_JOIN}{where} GROUP BY orders.date ORDER BY orders.date"
+        return sql, params
+
+    @classmethod
+    def _revenue_by_user_query(cls, n: int | None, filters: dict) -> tuple[str, tuple]:
+        _check_fields(cls, tuple(filters))
+        where, params = _where(cls.table, filters)
+        sql = (
+            f"SELECT orders.user_id, {cls._REVENUE} AS revenue FROM orders{cls._ITEMS_JOIN}{where}"
+            " GROUP BY orders.user_id ORDER BY revenue DESC LIMIT %s"
+        )
+        return sql, (*params, n)
+
+    @staticmethod
+    def _aggregate(sql: str, params: tuple) -> list[tuple]:
         with DatabaseConnection() as db:
-            db.cur.execute("DELETE FROM order_items WHERE id = %s RETURNING id", (id,))
-            return db.cur.fetchone() is not None
-
-
-print('User')
-# SELECT ALL USERS FROM USERS TABLE
-# ---------------------------------------
-# users = User.all()
-# print(users)
-
-# CREATE USER
-# ---------------------------------------
-# mark = User(name="Mark", phone="+380973334478", role="USER")
-# alice = User(name="Alice", phone="+380971234567", role="USER")
-# bob = User(name="Bob", phone="+380971234568", role="USER")
-# admin = User(name="Admin", phone="+380971234569", role="ADMIN")
-#print(f"Before creation {mark}")
-
-# mark.create()
-# alice.create()
-# bob.create()
-# admin.create()
-# print(f"After creation {mark}")
-
-
-# FILTER USERS
-# ---------------------------------------
-# users: list[User] = User.filter(role="USER")
-# print(users)
-
-# RETRIEVE USER
-# ---------------------------------------
-# print(User.all())
-# user: User = User.get(id=2)
-# print(user)
-
-# UPDATE USER
-# ---------------------------------------
-# mark = User.get(name="Mark")
-# mark.update(role="ADMIN")
-# print(mark)
-
-# DELETE USER
-# ---------------------------------------
-# delete_result = User.delete(id=3)  # TODO: should raise exception if no such id?
-# print(delete_result)
-# print(User.all())
-
-
-print('Dish')
-# print(Dish.all())
-# water = Dish('Water 0.5', 20.5)
-# salad = Dish('Salad', 134)
-# cake = Dish('Cake', 125.4)
-#
-# water.create()  # TODO: Dish name should be unique
-# salad.create()
-# cake.create()
-
-# print(Dish.all())
-# salad = Dish.get(name='Salad')
-# salad.update(price=145)
-# print(Dish.all())
-
-#
-
-print(User.all())
-print(Dish.all())
-
-order1 = Order('07-13-2025', 154.5, 'PENDING', 4).create()
-print(Order.all())
-
-order_item1 = OrderItem(1, 1, 2).create()
-order_item2 = OrderItem(1, 2, 2).create()
-print(OrderItem.all())
+            db.cur.execute(sql, params, prepare=True)
+            return db.cur.fetchall()
+
+
+@dataclass
+class OrderItem(Model, table="order_items"):
+    order_id: int
+    dish_id: int
+    quantity: int
+    id: int | None = None
+
+    order = ForeignKey("Order")
+    dish = ForeignKey("Dish")
+
+    constraints = ("CHECK (quantity > 0)",)
+
+
+if __name__ == "__main__":
+    print('User')
+    # SELECT ALL USERS FROM USERS TABLE
+    # ---------------------------------------
+    # users = list(User.all())
+    # print(users)
+
+    # CREATE USER
+    # ---------------------------------------
+    # mark = User(name="Mark", phone="+380973334478", role="USER")
+    # alice = User(name="Alice", phone="+380971234567", role="USER")
+    # bob = User(name="Bob", phone="+380971234568", role="USER")
+    # admin = User(name="Admin", phone="+380971234569", role="ADMIN")
+    #print(f"Before creation {mark}")
+
+    # mark.create()
+    # alice.create()
+    # bob.create()
+    # admin.create()
+    # print(f"After creation {mark}")
+
+
+    # FILTER USERS
+    # ---------------------------------------
+    # users: list[User] = list(User.filter(role="USER"))
+    # print(users)
+
+    # RETRIEVE USER
+    # ---------------------------------------
+    # print(list(User.all()))
+    # user: User = User.get(id=2)
+    # print(user)
+
+    # UPDATE USER
+    # ---------------------------------------
+    # mark = User.get(name="Mark")
+    # mark.update(role="ADMIN")
+    # print(mark)
+
+    # DELETE USER
+    # ---------------------------------------
+    # delete_result = User.delete(id=3)  # TODO: should raise exception if no such id?
+    # print(delete_result)
+    # print(list(User.all()))
+
+
+    print('Dish')
+    # print(list(Dish.all()))
+    # water = Dish('Water 0.5', 20.5)
+    # salad = Dish('Salad', 134)
+    # cake = Dish('Cake', 125.4)
+    #
+    # water.create()  # TODO: Dish name should be unique
+    # salad.create()
+    # cake.create()
+
+    # print(list(Dish.all()))
+    # salad = Dish.get(name='Salad')
+    # salad.update(price=145)
+    # print(list(Dish.all()))
+
+    #
+
+    print(list(User.all()))
+    print(list(Dish.all()))
+
+    order1 = Order('07-13-2025', 154.5, 'PENDING', 4).create()
+    print(list(Order.all()))
+
+    order_item1 = OrderItem(1, 1, 2).create()
+    order_item2 = OrderItem(1, 2, 2).create()
+    print(list(OrderItem.all()))
@@ -0,0 +1,403 @@
+"""Async variant of ORM models on psycopg AsyncConnectionPool
+
+Models mirror ORM.py and share its SQL, but every method doing I/O is a coroutine:
+
+    users = await User.filter(role="USER")
+    async for order in Order.all().select_related("user").prefetch_related("items__dish"):
+        ...
+    dish = await Dish.get(id=1)
+
+A task takes connection from the pool only for a query, or for `async with connection():` block,
+which is one transaction, so many concurrent requests share a few connections.
+Relations are loaded by select_related/prefetch_related only, as loading on attribute access
+would block the event loop.
+"""
+import asyncio
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import date
+from itertools import count
+from typing import Self
+
+from psycopg import AsyncConnection
+from psycopg.rows import dict_row, tuple_row
+from psycopg_pool import AsyncConnectionPool
+
+import ORM
+from ORM import (ANALYZE_THRESHOLD, BATCH_SIZE, ForeignKey, QuerySet, _check_fields, _compile, _joined_row_factory,
+                 _relation, connection_payload, model_cache, pool_settings)
+
+_pool: AsyncConnectionPool | None = None
+_pool_lock: asyncio.Lock | None = None
+_pool_loop: asyncio.AbstractEventLoop | None = None  # event loop the pool and its lock belong to
+_connection: ContextVar[AsyncConnection | None] = ContextVar("connection", default=None)
+_changes: ContextVar[list] = ContextVar("changes")
+_cursor_numbers = count()
+
+
+def _get_pool_lock() -> asyncio.Lock:
+    """return lock of the pool for running event loop.
+
+    Lock and pool are bound to the loop they are created in, so they are created again in every new loop,
+    e.g. in every asyncio.run(). Pool left by previous loop without close_pool can't be used in the new one.
+    """
+
+    global _pool, _pool_lock, _pool_loop
+    loop = asyncio.get_running_loop()
+    if loop is not _pool_loop:
+        _pool, _pool_lock, _pool_loop = None, asyncio.Lock(), loop
+    return _pool_lock
+
+
+async def get_pool() -> AsyncConnectionPool:
+    """return connection pool, it is opened on first use in running event loop."""
+
+    global _pool
+    async with _get_pool_lock():
+        if _pool is None:
+            settings = {**pool_settings, "check": AsyncConnectionPool.check_connection}
+            _pool = AsyncConnectionPool(kwargs=connection_payload, open=False, **settings)
+            await _pool.open()
+    return _pool
+
+
+async def close_pool() -> None:
+    global _pool
+    async with _get_pool_lock():
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+
+@asynccontextmanager
+async def connection() -> AsyncIterator[AsyncConnection]:
+    """connection of current task, nested blocks reuse it.
+
+    Transaction is committed (or rolled back on exception) when the outermost block exits,
+    nested blocks are savepoints as in ORM.DatabaseConnection.
+    """
+
+    conn = _connection.get()
+    if conn is not None:
+        async with conn.transaction():
+            yield conn
+        return
+
+    changes = []
+    pool = await get_pool()
+    try:
+        async with pool.connection() as conn:
+            conn_token, changes_token = _connection.set(conn), _changes.set(changes)
+            try:
+                async with conn.transaction():
+                    yield conn
+            finally:
+                _connection.reset(conn_token)
+                _changes.reset(changes_token)
+    finally:
+        # committed or rolled back, see ORM.DatabaseConnection._release
+        for model, ids in changes:
+            if model.cache_ttl:
+                model_cache.discard(model, ids)
+
+
+def _changed(model: type[ORM.Model], ids: list[int]) -> None:
+    """drop changed rows from cache now and once more when the transaction ends, as in ORM._changed."""
+
+    _changes.get().append((model, ids))
+    if model.cache_ttl:
+        model_cache.discard(model, ids)
+
+
+async def _fetch(model: type[ORM.Model], sql: str, params: tuple, row_factory=None) -> list:
+    async with connection() as conn:
+        cur = conn.cursor(row_factory=row_factory or model._row_factory)
+        await cur.execute(sql, params, prepare=True)
+        return await cur.fetchall()
+
+
+async def _stream(model: type[ORM.Model], sql: str, params: tuple, row_factory, batch_size: int = BATCH_SIZE):
+    """yield rows of query through server-side cursor, as ORM._stream."""
+
+    async with connection() as conn:
+        name = f"{model.table}_{next(_cursor_numbers)}"
+        async with conn.cursor(name=name, row_factory=row_factory) as cur:
+            cur.itersize = batch_size
+            await cur.execute(sql, params)
+            async for row in cur:
+                yield row
+
+
+async def _fetch_any(model: type[ORM.Model], column: str, values) -> list:
+    return await _fetch(model, _compile(model, "any", (column,)), (list(values),))
+
+
+async def _prefetch(instances: list, lookup: str) -> None:
+    """load relation for all instances with one query, as ORM._prefetch."""
+
+    if not instances:
+        return
+    name, _, rest = lookup.partition("__")
+    model = type(instances[0])
+    relation = _relation(model, name)
+    related_model = relation.related_model(model)
+
+    not_loaded = [instance for instance in instances if name not in instance.__dict__]
+    if not_loaded and isinstance(relation, ForeignKey):
+        related = await related_model.get_many(getattr(instance, relation.column) for instance in not_loaded)
+        for instance in not_loaded:
+            instance.__dict__[name] = related.get(getattr(instance, relation.column))
+    elif not_loaded:
+        related = defaultdict(list)
+        for obj in await _fetch_any(related_model, relation.column, {instance.id for instance in not_loaded}):
+            related[getattr(obj, relation.column)].append(obj)
+        for instance in not_loaded:
+            instance.__dict__[name] = related.get(instance.id, [])
+
+    if rest:
+        await _prefetch([obj for instance in instances for obj in relation.related_objects(instance)], rest)
+
+
+class AsyncQuerySet(QuerySet):
+    """QuerySet, which is awaited for the list of rows or iterated with `async for`."""
+
+    def __await__(self):
+        return self._list().__await__()
+
+    async def _list(self) -> list:
+        return [row async for row in self]
+
+    def __aiter__(self) -> AsyncIterator:
+        return self.iterator()
+
+    async def iterator(self, batch_size: int = BATCH_SIZE) -> AsyncIterator:
+        """yield rows fetched by batch_size at once."""
+
+        prefetch = () if self.value_fields else self.prefetch
+        rows = self._rows(batch_size)
+        try:
+            async for batch in _batches(rows, batch_size):
+                for lookup in prefetch:
+                    await _prefetch(batch, lookup)
+                for row in batch:
+                    yield row
+        finally:
+            await rows.aclose()
+
+    async def _rows(self, batch_size: int) -> AsyncIterator:
+        sql, params = self._query()
+        if self.value_fields:
+            row_factory = dict_row
+        elif self.related:
+            row_factory = _joined_row_factory(self.model, self.related)
+        else:
+            row_factory = self.model._row_factory
+
+        if self.limit_value is not None and self.limit_value <= batch_size:
+            # the result fits one batch, so it is fetched with prepared statement instead of cursor
+            for row in await _fetch(self.model, sql, params, row_factory):
+                yield row
+            return
+
+        rows = _stream(self.model, sql, params, row_factory, batch_size)
+        try:
+            async for row in rows:
+                yield row
+        finally:
+            await rows.aclose()
+
+    async def _scalar(self, wrap: str):
+        sql, params = self._query(wrap)
+        async with connection() as conn:
+            cur = await conn.execute(sql, params, prepare=True)
+            return (await cur.fetchone())[0]
+
+    async def first(self):
+        """return first row or None."""
+
+        rows = await self.limit(1)
+        return rows[0] if rows else None
+
+    async def count(self) -> int:
+        return await super().count()
+
+    async def exists(self) -> bool:
+        return await super().exists()
+
+
+async def _batches(rows: AsyncIterator, size: int) -> AsyncIterator[list]:
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class AsyncModel:
+    """Async methods for ORM models, to be mixed in before the sync model:
+
+        class User(AsyncModel, ORM.User, table="users", cache_ttl=30):
+            pass
+    """
+
+    lazy_relations = False
+
+    @classmethod
+    def all(cls) -> AsyncQuerySet:
+        return AsyncQuerySet(cls)
+
+    @classmethod
+    def filter(cls, **filters) -> AsyncQuerySet:
+        return AsyncQuerySet(cls).filter(**filters)
+
+    @classmethod
+    def exclude(cls, **filters) -> AsyncQuerySet:
+        return AsyncQuerySet(cls).exclude(**filters)
+
+    @classmethod
+    async def get(cls, **filters) -> Self | None:
+        if filters.keys() == {"id"}:
+            return (await cls.get_many([filters["id"]])).get(filters["id"])
+        return await AsyncQuerySet(cls).filter(**filters).first()
+
+    @classmethod
+    async def get_many(cls, ids) -> dict[int, Self]:
+        """return instances by ids, rows not found in model_cache are selected by one query."""
+
+        # reads of the task with uncommitted changes bypass model_cache, as in ORM.Model.get_many
+        cached = cls.cache_ttl and not _changes.get(None)
+        found, missing = {}, []
+        for id in set(ids) - {None}:
+            instance = model_cache.get(cls, id) if cached else None
+            if instance is None:
+                missing.append(id)
+            else:
+                found[id] = instance
+
+        if missing:
+            for instance in await _fetch_any(cls, "id", missing):
+                found[instance.id] = instance
+                if cached:
+                    model_cache.put(instance)
+        return found
+
+    async def create(self) -> Self:
+        values = tuple(getattr(self, column) for column in self.columns()[:-1])
+        async with connection() as conn:
+            cur = await conn.execute(_compile(type(self), "insert"), values, prepare=True)
+            self.id = (await cur.fetchone())[0]
+            _changed(type(self), [self.id])
+        return self
+
+    async def update(self, **payload) -> Self | None:
+        if self.id is None:
+            raise ValueError(f"Can not update {type(self).__name__} without ID")
+
+        keys = tuple(sorted(payload))
+        async with connection() as conn:
+            cur = await conn.execute(
+                _compile(type(self), "update", keys),
+                (*(payload[key] for key in keys), self.id),
+                prepare=True,
+            )
+            row = await cur.fetchone()
+            _changed(type(self), [self.id])
+
+        if not row:
+            return None
+        for column, value in zip(self.columns(), row):
+            setattr(self, column, value)
+        return self
+
+    @classmethod
+    async def delete(cls, id: int) -> bool:
+        async with connection() as conn:
+            cur = await conn.execute(_compile(cls, "delete"), (id,), prepare=True)
+            _changed(cls, [id])
+            return await cur.fetchone() is not None
+
+    @classmethod
+    async def bulk_create(cls, instances: list[Self]) -> list[Self]:
+        """insert instances with COPY, as ORM.Model.bulk_create."""
+
+        columns = cls.columns()[:-1]
+        new = [instance for instance in instances if instance.id is None]
+
+        async with connection() as conn:
+            cur = conn.cursor()
+            await cur.execute(_compile(cls, "next_ids"), (len(new),))
+            new_ids = iter([row[0] for row in await cur.fetchall()])
+            ids = [next(new_ids) if instance.id is None else instance.id for instance in instances]
+
+            async with cur.copy(_compile(cls, "copy")) as copy:
+                for id, instance in zip(ids, instances):
+                    await copy.write_row((id, *(getattr(instance, column) for column in columns)))
+            if len(instances) >= ANALYZE_THRESHOLD:
+                await cur.execute(f"ANALYZE {cls.table}")
+            _changed(cls, ids)
+
+        for id, instance in zip(ids, instances):
+            instance.id = id
+        return instances
+
+    @classmethod
+    async def bulk_update(cls, instances: list[Self], fields: list[str]) -> int:
+        """update given fields of instances with one statement, as ORM.Model.bulk_update."""
+
+        fields = tuple(fields)
+        _check_fields(cls, fields)
+        if any(instance.id is None for instance in instances):
+            raise ValueError(f"Can not update {cls.__name__} without ID")
+
+        async with connection() as conn:
+            cur = conn.cursor()
+            await cur.execute(_compile(cls, "bulk_table", fields))
+            async with cur.copy(_compile(cls, "bulk_copy", fields)) as copy:
+                for instance in instances:
+                    await copy.write_row((instance.id, *(getattr(instance, field) for field in fields)))
+            await cur.execute(_compile(cls, "bulk_update", fields))
+            updated = cur.rowcount
+            await cur.execute(_compile(cls, "bulk_drop"))
+            _changed(cls, [instance.id for instance in instances])
+        return updated
+
+
+class User(AsyncModel, ORM.User, table="users", cache_ttl=30):
+    pass
+
+
+class Dish(AsyncModel, ORM.Dish, table="dishes", cache_ttl=300):
+    @classmethod
+    async def top_sellers(cls, n: int = 10) -> list[tuple[Self, int]]:
+        return await _fetch(cls, cls._top_sellers_sql(), (n,), cls._top_sellers_row_factory)
+
+
+class Order(AsyncModel, ORM.Order, table="orders"):
+    @classmethod
+    def with_totals(cls, **filters) -> AsyncIterator[Self]:
+        """iterate with `async for`, see ORM.Order.with_totals."""
+
+        return _stream(cls, *cls._with_totals_query(filters), cls._row_factory)
+
+    @classmethod
+    async def update_totals(cls) -> int:
+        async with connection() as conn:
+            cur = await conn.execute(cls._update_totals_sql())
+            return cur.rowcount
+
+    @classmethod
+    async def revenue_by_day(cls, start: date | None = None, end: date | None = None, **filters) -> list[tuple[date, float]]:
+        return await _fetch(cls, *cls._revenue_by_day_query(start, end, filters), tuple_row)
+
+    @classmethod
+    async def revenue_by_user(cls, n: int | None = None, **filters) -> list[tuple[int, float]]:
+        return await _fetch(cls, *cls._revenue_by_user_query(n, filters), tuple_row)
+
+
+class OrderItem(AsyncModel, ORM.OrderItem, table="order_items"):
+    pass
@@ -0,0 +1,384 @@
+"""Benchmarks for ORM
+
+Needs PostgreSQL with tables from HW/hw14/README.md and connection settings from ORM.py.
+Run from HW/hw15 directory:
+    python benchmark.py
+"""
+import asyncio
+import random
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from unittest import mock
+
+import psycopg
+
+import async_orm
+import ORM
+from ORM import (DatabaseConnection, Dish, Order, OrderItem, QueryCounter, User, connection_payload, model_cache,
+                 transaction)
+
+QUERIES = 500
+THREADS = (1, 4)
+BULK_SIZES = (1_000, 10_000, 100_000)
+ITERATION_SIZES = (100_000, 1_000_000)
+PAGE_SIZES = (10, 100, 1_000)
+ITEMS_PER_ORDER = 3
+MENU_SIZE = 100
+ORDERS = 200
+CONCURRENCY = (1, 10, 100)
+TOTALS_SIZES = (10_000, 100_000)
+
+
+class DirectConnection(ORM.DatabaseConnection):
+    """Previous behaviour: new connection for every query"""
+
+    def __enter__(self):
+        self.conn = psycopg.connect(**connection_payload)
+        self.cur = self.conn.cursor()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type:
+            self.conn.rollback()
+        else:
+            self.conn.commit()
+        self.cur.close()
+        self.conn.close()
+
+
+def queries_per_second(user_id: int, threads: int) -> float:
+    """Runs QUERIES lookups of user by id in given number of threads"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for user in executor.map(lambda _: User.get(id=user_id), range(QUERIES)):
+            assert user.id == user_id
+    return QUERIES / (time.perf_counter() - start)
+
+
+def benchmark_pool(user_id: int, threads: int):
+    """Compares User.get with new connection per query and with connection pool
+
+    Threads    Direct, q/s    Pool, q/s
+    1          158            1739
+    4          165            1696
+
+    Measured on 1 CPU with PostgreSQL on localhost (password authentication over TCP).
+    model_cache is off, otherwise both would measure cache hits.
+    """
+    with mock.patch.object(User, "cache_ttl", None):
+        with mock.patch.object(ORM, "DatabaseConnection", DirectConnection):
+            direct = queries_per_second(user_id, threads)
+
+        ORM.get_pool().wait()  # min_size connections are opened in background
+        pool = queries_per_second(user_id, threads)
+    return direct, pool
+
+
+def rows_per_second(func, number_of_rows: int) -> float:
+    start = time.perf_counter()
+    func()
+    return number_of_rows / (time.perf_counter() - start)
+
+
+def benchmark_bulk(number_of_dishes: int):
+    """Compares create/update of dishes one by one with bulk_create/bulk_update
+
+    Dishes      create, rows/s    bulk_create, rows/s    update, rows/s    bulk_update, rows/s
+    1_000       1448              52702                  1176              53528
+    10_000      1556              78556                  1500              98734
+    100_000     1858              94817                  1685              81693
+    """
+    dishes = [Dish(f"Dish {i}", i % 500) for i in range(number_of_dishes)]
+    create = rows_per_second(lambda: [dish.create() for dish in dishes], number_of_dishes)
+    update = rows_per_second(lambda: [dish.update(price=dish.price + 1) for dish in dishes], number_of_dishes)
+
+    bulk_dishes = [Dish(f"Dish {i}", i % 500) for i in range(number_of_dishes)]
+    bulk_create = rows_per_second(lambda: Dish.bulk_create(bulk_dishes), number_of_dishes)
+    assert all(dish.id is not None for dish in bulk_dishes)
+    for dish in bulk_dishes:
+        dish.price += 1
+    bulk_update = rows_per_second(lambda: Dish.bulk_update(bulk_dishes, ["price"]), number_of_dishes)
+
+    with DatabaseConnection() as db:
+        db.cur.execute("DELETE FROM dishes WHERE id = ANY(%s)", ([dish.id for dish in dishes + bulk_dishes],))
+    return create, bulk_create, update, bulk_update
+
+
+def measure_memory(func) -> tuple[float, float]:
+    """return duration in seconds and peak memory in MB (measured in separate run, as tracing is slow)"""
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak / 1024 / 1024
+
+
+def benchmark_iteration(user_id: int, number_of_orders: int):
+    """Compares fetchall of orders into list (previous behaviour of Order.filter) with streaming QuerySet
+
+    Orders      fetchall, s    fetchall, MB    QuerySet, s    QuerySet, MB
+    100_000     0.33           43.3            0.39           1.4
+    1_000_000   3.11           435.2           4.00           1.4
+
+    QuerySet memory does not depend on number of rows, the price is a round trip per BATCH_SIZE rows.
+    """
+    Order.bulk_create([Order(date(2025, 7, 1), 10, "PENDING", user_id) for _ in range(number_of_orders)])
+
+    def fetch_all():
+        with DatabaseConnection() as db:
+            rows = db.query("SELECT date, total, status, user_id, id FROM orders WHERE user_id = %s", (user_id,))
+            orders = [Order(*row) for row in rows]
+        assert len(orders) == number_of_orders
+
+    def stream():
+        assert sum(1 for _ in Order.filter(user_id=user_id)) == number_of_orders
+
+    fetch_all_time, fetch_all_memory = measure_memory(fetch_all)
+    stream_time, stream_memory = measure_memory(stream)
+
+    with DatabaseConnection() as db:
+        db.cur.execute("DELETE FROM orders WHERE user_id = %s", (user_id,))
+    return fetch_all_time, fetch_all_memory, stream_time, stream_memory
+
+
+def render_order_page(orders) -> list[str]:
+    """Order list page: every order with user name and dishes of its items"""
+    return [
+        f"{order.id} {order.user.name}: " + ", ".join(f"{item.dish.name} x {item.quantity}" for item in order.items)
+        for order in orders
+    ]
+
+
+def benchmark_order_page(user_id: int, number_of_orders: int):
+    """Compares order list page with relations loaded on access (N+1 queries) and loaded with the orders.
+    Without model_cache every order takes 5 queries on access: user, items and ITEMS_PER_ORDER dishes.
+
+    Orders    On access, queries    On access, s    Eager, queries    Eager, s
+    10        51                    0.0445          3                 0.0045
+    100       501                   0.2821          3                 0.0052
+    1_000     5001                  2.4794          3                 0.0612
+    """
+    dishes = Dish.bulk_create([Dish(f"Dish {i}", 100 + i) for i in range(ITEMS_PER_ORDER)])
+    orders = Order.bulk_create([Order(date(2025, 7, 1), 10, "PENDING", user_id) for _ in range(number_of_orders)])
+    OrderItem.bulk_create([OrderItem(order.id, dish.id, 1) for order in orders for dish in dishes])
+
+    def measure_page(queryset):
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            page = render_order_page(queryset)
+            duration = time.perf_counter() - start
+        assert len(page) == number_of_orders
+        return counter.count, duration
+
+    # model_cache is off, so every user and dish loaded on access is a query, as without the cache
+    with mock.patch.object(User, "cache_ttl", None), mock.patch.object(Dish, "cache_ttl", None):
+        lazy_queries, lazy = measure_page(Order.filter(user_id=user_id))
+        eager_queries, eager = measure_page(
+            Order.filter(user_id=user_id).select_related("user").prefetch_related("items__dish")
+        )
+    assert eager_queries == 3  # orders with users, items, dishes
+
+    with DatabaseConnection() as db:
+        db.cur.execute("DELETE FROM order_items WHERE order_id = ANY(%s)", ([order.id for order in orders],))
+        db.cur.execute("DELETE FROM orders WHERE user_id = %s", (user_id,))
+        db.cur.execute("DELETE FROM dishes WHERE id = ANY(%s)", ([dish.id for dish in dishes],))
+    return lazy_queries, lazy, eager_queries, eager
+
+
+def benchmark_cache():
+    """Compares Dish.get(id=...) for random dishes of the menu without cache and with model_cache
+
+    No cache, q/s    Cache, q/s    Hit rate
+    2733             74319         0.980
+    """
+    dishes = Dish.bulk_create([Dish(f"Dish {i}", 100 + i) for i in range(MENU_SIZE)])
+    ids = [random.choice(dishes).id for _ in range(QUERIES * 10)]
+
+    def lookups_per_second():
+        start = time.perf_counter()
+        for id in ids:
+            assert Dish.get(id=id).id == id
+        return len(ids) / (time.perf_counter() - start)
+
+    with mock.patch.object(Dish, "cache_ttl", None):
+        no_cache = lookups_per_second()
+    model_cache.clear()
+    cache = lookups_per_second()
+    hit_rate = model_cache.stats()["hit_rate"]
+
+    with DatabaseConnection() as db:
+        db.cur.execute("DELETE FROM dishes WHERE id = ANY(%s)", ([dish.id for dish in dishes],))
+    return no_cache, cache, hit_rate
+
+
+def benchmark_transaction(user_id: int):
+    """Compares placing order with ITEMS_PER_ORDER items by separate create calls (commit per row)
+    and by one transaction
+
+    Separate, orders/s    Transaction, orders/s    Separate, queries    Transaction, queries
+    234                   511                      4                    3
+
+    Separate calls take 4 round trips and 4 commits per order, transaction takes 2 round trips and 1 commit.
+    """
+    dishes = Dish.bulk_create([Dish(f"Dish {i}", 100 + i) for i in range(ITEMS_PER_ORDER)])
+
+    def place_order_separately():
+        order = Order(date(2025, 7, 1), 10, "PENDING", user_id).create()
+        for dish in dishes:
+            OrderItem(order.id, dish.id, 1).create()
+
+    def place_order_in_transaction():
+        with transaction() as session:
+            order = session.add(Order(date(2025, 7, 1), 10, "PENDING", user_id))
+            for dish in dishes:
+                session.add(OrderItem(None, dish.id, 1), order=order)
+
+    results = []
+    for place_order in (place_order_separately, place_order_in_transaction):
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            for _ in range(ORDERS):
+                place_order()
+            results += [ORDERS / (time.perf_counter() - start), counter.count // ORDERS]
+
+    with DatabaseConnection() as db:
+        db.cur.execute("DELETE FROM order_items WHERE dish_id = ANY(%s)", ([dish.id for dish in dishes],))
+        db.cur.execute("DELETE FROM orders WHERE user_id = %s", (user_id,))
+        db.cur.execute("DELETE FROM dishes WHERE id = ANY(%s)", ([dish.id for dish in dishes],))
+    separate, separate_queries, in_transaction, transaction_queries = results
+    return separate, in_transaction, separate_queries, transaction_queries
+
+
+async def async_queries_per_second(user_id: int, concurrency: int) -> tuple[float, int]:
+    """Runs QUERIES lookups of user by phone in given number of concurrent tasks,
+    return queries/sec and number of connections in the pool"""
+    user = await async_orm.User.get(id=user_id)
+    queue = asyncio.Queue()
+    for _ in range(QUERIES):
+        queue.put_nowait(user.phone)
+
+    async def worker():
+        while not queue.empty():
+            assert (await async_orm.User.get(phone=queue.get_nowait())).id == user_id
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    return QUERIES / duration, (await async_orm.get_pool()).get_stats()["pool_size"]
+
+
+def benchmark_async(user_id: int, concurrency: int):
+    """Compares async ORM lookups with different number of concurrent tasks on pool of max 10 connections
+
+    Tasks    q/s     Connections
+    1        1762    3
+    10       1279    10
+    100      1215    10
+
+    100 concurrent tasks are served by 10 connections. Measured on 1 CPU shared with PostgreSQL,
+    so concurrency does not add throughput here.
+    """
+    async def run():
+        try:
+            return await async_queries_per_second(user_id, concurrency)
+        finally:
+            await async_orm.close_pool()
+
+    return asyncio.run(run())
+
+
+def benchmark_totals(user_id: int, number_of_orders: int):
+    """Compares totals of orders computed in Python from prefetched items and dishes
+    with Order.with_totals, which computes them by one grouped query
+
+    Orders      Python, s    SQL, s    Revenue by day in SQL, s
+    10_000      0.285        0.105     0.181
+    100_000     2.780        0.865     0.359
+    """
+    dishes = Dish.bulk_create([Dish(f"Dish {i}", 100 + i) for i in range(MENU_SIZE)])
+    orders = Order.bulk_create([Order(date(2025, 7, 1), 0, "PENDING", user_id) for _ in range(number_of_orders)])
+    OrderItem.bulk_create(
+        [OrderItem(order.id, random.choice(dishes).id, 2) for order in orders for _ in range(ITEMS_PER_ORDER)]
+    )
+
+    start = time.perf_counter()
+    python_totals = {
+        order.id: sum(item.quantity * item.dish.price for item in order.items)
+        for order in Order.filter(user_id=user_id).prefetch_related("items__dish")
+    }
+    python = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sql_totals = {order.id: order.total for order in Order.with_totals(user_id=user_id)}
+    sql = time.perf_counter() - start
+    assert python_totals == sql_totals
+
+    start = time.perf_counter()
+    (_, revenue), = Order.revenue_by_day(user_id=user_id)
+    revenue_by_day = time.perf_counter() - start
+    assert revenue == sum(python_totals.values())
+
+    with DatabaseConnection() as db:
+        db.cur.execute("DELETE FROM order_items WHERE order_id = ANY(%s)", ([order.id for order in orders],))
+        db.cur.execute("DELETE FROM orders WHERE user_id = %s", (user_id,))
+        db.cur.execute("DELETE FROM dishes WHERE id = ANY(%s)", ([dish.id for dish in dishes],))
+    return python, sql, revenue_by_day
+
+
+def main():
+    user = User(name="Benchmark", phone=f"+{time.time_ns()}", role="USER").create()
+    try:
+        print(f"{'Threads':<11}{'Direct, q/s':<15}{'Pool, q/s':<15}")
+        for threads in THREADS:
+            direct, pool = benchmark_pool(user.id, threads)
+            print(f"{threads:<11}{direct:<15.0f}{pool:<15.0f}")
+        print(f"\n{'Orders':<12}{'Python, s':<13}{'SQL, s':<10}{'Revenue by day in SQL, s':<26}")
+        for number_of_orders in TOTALS_SIZES:
+            python, sql, revenue_by_day = benchmark_totals(user.id, number_of_orders)
+            print(f"{number_of_orders:<12_}{python:<13.3f}{sql:<10.3f}{revenue_by_day:<26.3f}")
+
+        print(f"\n{'Tasks':<9}{'q/s':<8}{'Connections':<12}")
+        for concurrency in CONCURRENCY:
+            queries, connections = benchmark_async(user.id, concurrency)
+            print(f"{concurrency:<9}{queries:<8.0f}{connections:<12}")
+    finally:
+        User.delete(user.id)
+
+    print(f"\n{'No cache, q/s':<17}{'Cache, q/s':<14}{'Hit rate':<10}")
+    no_cache, cache, hit_rate = benchmark_cache()
+    print(f"{no_cache:<17.0f}{cache:<14.0f}{hit_rate:<10.3f}")
+
+    print(f"\n{'Dishes':<12}{'create, rows/s':<18}{'bulk_create, rows/s':<23}{'update, rows/s':<18}{'bulk_update, rows/s':<23}")
+    for number_of_dishes in BULK_SIZES:
+        create, bulk_create, update, bulk_update = benchmark_bulk(number_of_dishes)
+        print(f"{number_of_dishes:<12_}{create:<18.0f}{bulk_create:<23.0f}{update:<18.0f}{bulk_update:<23.0f}")
+
+    user = User(name="Benchmark", phone=f"+{time.time_ns()}", role="USER").create()
+    try:
+        print(f"\n{'Orders':<12}{'fetchall, s':<15}{'fetchall, MB':<16}{'QuerySet, s':<15}{'QuerySet, MB':<15}")
+        for number_of_orders in ITERATION_SIZES:
+            fetch_all_time, fetch_all_memory, stream_time, stream_memory = benchmark_iteration(user.id, number_of_orders)
+            print(f"{number_of_orders:<12_}{fetch_all_time:<15.2f}{fetch_all_memory:<16.1f}"
+                  f"{stream_time:<15.2f}{stream_memory:<15.1f}")
+
+        print(f"\n{'Orders':<10}{'On access, queries':<22}{'On access, s':<16}{'Eager, queries':<18}{'Eager, s':<12}")
+        for number_of_orders in PAGE_SIZES:
+            lazy_queries, lazy, eager_queries, eager = benchmark_order_page(user.id, number_of_orders)
+            print(f"{number_of_orders:<10_}{lazy_queries:<22}{lazy:<16.4f}{eager_queries:<18}{eager:<12.4f}")
+
+        print(f"\n{'Separate, orders/s':<22}{'Transaction, orders/s':<25}{'Separate, queries':<21}"
+              f"{'Transaction, queries':<22}")
+        separate, in_transaction, separate_queries, transaction_queries = benchmark_transaction(user.id)
+        print(f"{separate:<22.0f}{in_transaction:<25.0f}{separate_queries:<21}{transaction_queries:<22}")
+    finally:
+        User.delete(user.id)
+
+
+if __name__ == "__main__":
+    main()
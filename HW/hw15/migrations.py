@@ -0,0 +1,151 @@
+"""Schema migrations for ORM models
+
+Tables are created from the models of ORM.py: columns from dataclass fields, foreign keys
+from ForeignKey descriptors and constraints from `Model.constraints`. Indexes are created on
+foreign keys and on `Model.indexes`, so filters and joins on them are not sequential scans.
+
+Applied versions are recorded in `schema_migrations` table, every migration runs in its own
+transaction and is applied once:
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --list     # show applied and pending migrations
+    python migrations.py --sql      # print DDL of the models
+
+Tables of existing databases are kept (CREATE TABLE IF NOT EXISTS), so the first migration
+can be applied to the database created from HW/hw14/README.md. Changes of models
+after the first migration need new migrations with their own SQL.
+"""
+import argparse
+import types
+from collections.abc import Callable
+from dataclasses import fields
+from datetime import date, datetime
+from graphlib import TopologicalSorter
+
+import psycopg
+
+from ORM import DatabaseConnection, Dish, Model, Order, OrderItem, User, _dependencies, _foreign_keys, create_indexes
+
+MODELS = [User, Dish, Order, OrderItem]
+SQL_TYPES = {
+    int: "INTEGER",
+    str: "TEXT",
+    float: "NUMERIC(10, 2)",
+    bool: "BOOLEAN",
+    date: "DATE",
+    datetime: "TIMESTAMP",
+}
+LOCK_ID = 1501  # advisory lock, so concurrent runs apply migrations one by one
+
+migrations: list[tuple[int, str, Callable[[psycopg.Cursor], None]]] = []
+
+
+def migration(version: int, name: str):
+    """register decorated function(cursor) as migration, versions are applied in ascending order."""
+
+    def register(func):
+        if any(version == registered for registered, _, _ in migrations):
+            raise ValueError(f"Migration {version} is already registered")
+        migrations.append((version, name, func))
+        migrations.sort(key=lambda migration: migration[0])
+        return func
+
+    return register
+
+
+def sorted_models(models: list[type[Model]]) -> list[type[Model]]:
+    """models in order of creation: referenced tables first."""
+
+    graph = {model: _dependencies(model) & set(models) for model in models}
+    return list(TopologicalSorter(graph).static_order())
+
+
+def column_type(annotation) -> tuple[str, bool]:
+    """return SQL type of field annotation and whether the column is nullable."""
+
+    nullable = isinstance(annotation, types.UnionType) and type(None) in annotation.__args__
+    if nullable:
+        annotation, = (arg for arg in annotation.__args__ if arg is not type(None))
+    if annotation not in SQL_TYPES:
+        raise TypeError(f"No SQL type for {annotation}")
+    return SQL_TYPES[annotation], nullable
+
+
+def create_table_sql(model: type[Model]) -> str:
+    references = {relation.column: relation.related_model(model) for relation in _foreign_keys(model)}
+    lines = ["id SERIAL PRIMARY KEY"]
+    for field in fields(model):
+        if field.name == "id":
+            continue
+        sql_type, nullable = column_type(field.type)
+        line = f"{field.name} {sql_type}" + ("" if nullable else " NOT NULL")
+        if field.name in references:
+            line += f" REFERENCES {references[field.name].table} (id)"
+        lines.append(line)
+    lines += model.constraints
+    return f"CREATE TABLE IF NOT EXISTS {model.table} (\n    " + ",\n    ".join(lines) + "\n)"
+
+
+def schema_sql(models: list[type[Model]] = MODELS) -> list[str]:
+    return [create_table_sql(model) for model in sorted_models(models)]
+
+
+@migration(1, "create tables")
+def create_tables(cur: psycopg.Cursor) -> None:
+    for sql in schema_sql():
+        cur.execute(sql)
+
+
+@migration(2, "create indexes on foreign keys and filtered columns")
+def create_model_indexes(cur: psycopg.Cursor) -> None:
+    # create_indexes takes the same connection, as DatabaseConnection blocks are nested
+    names = create_indexes(MODELS)
+    cur.execute("ANALYZE " + ", ".join(model.table for model in MODELS))
+    print(f"    {', '.join(names)}")
+
+
+def applied_versions(cur: psycopg.Cursor) -> set[int]:
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+    )
+    cur.execute("SELECT version FROM schema_migrations")
+    return {version for version, in cur.fetchall()}
+
+
+def migrate() -> list[int]:
+    """apply pending migrations, return their versions."""
+
+    applied = []
+    for version, name, func in migrations:
+        with DatabaseConnection() as db:
+            db.cur.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_ID,))
+            if version in applied_versions(db.cur):
+                continue
+            print(f"Applying {version}: {name}")
+            func(db.cur)
+            db.cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        applied.append(version)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--list", action="store_true", help="show applied and pending migrations")
+    parser.add_argument("--sql", action="store_true", help="print CREATE TABLE statements of the models")
+    args = parser.parse_args()
+
+    if args.sql:
+        print(";\n\n".join(schema_sql()) + ";")
+    elif args.list:
+        with DatabaseConnection() as db:
+            applied = applied_versions(db.cur)
+        for version, name, _ in migrations:
+            print(f"[{'x' if version in applied else ' '}] {version}: {name}")
+    else:
+        applied = migrate()
+        print(f"Applied {len(applied)} migration(s)")
+
+
+if __name__ == "__main__":
+    main()
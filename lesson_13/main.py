@@ -2,7 +2,8 @@ import uuid
 from dataclasses import dataclass
 import random
 import abc
-import queue
+import heapq
+import itertools
 import threading
 import time
 from datetime import datetime, timedelta
@@ -119,9 +120,45 @@ class Uber(DeliveryService):
         self._ship(delay)
 
 
+class DelayQueue:
+    """Orders in a heap by due time.
+
+    get() blocks until the earliest order is due, put() wakes a waiting thread to look
+    at the head again, so nothing is polled. A thread which takes an order wakes the next
+    one, if more orders are left, so all consumers are kept busy.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, OrderRequestBody]] = []
+        self._counter = itertools.count()  # orders due at the same time keep the order of adding
+        self._condition = threading.Condition()
+
+    def put(self, order: OrderRequestBody) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (order[1], next(self._counter), order))
+            self._condition.notify()
+
+    def get(self) -> OrderRequestBody:
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                time_to_wait = (self._heap[0][0] - datetime.now()).total_seconds()
+                if time_to_wait <= 0:
+                    order = heapq.heappop(self._heap)[2]
+                    if self._heap:
+                        self._condition.notify()
+                    return order
+                self._condition.wait(time_to_wait)
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+
 class Scheduler:
     def __init__(self):
-        self.orders: queue.Queue[OrderRequestBody] = queue.Queue()
+        self.orders = DelayQueue()
 
     @staticmethod
     def _service_dispatcher() -> type[DeliveryService]:
@@ -148,16 +185,9 @@ class Scheduler:
         print("ORDERS PROCESSING...")
 
         while True:
-            order = self.orders.get(True)
-
-            time_to_wait = order[1] - datetime.now()
-
-            if time_to_wait.total_seconds() > 0:
-                self.orders.put(order)
-                time.sleep(0.5)
-            else:
-                self.ship_order(order[0])
-                # print(f"\n\t{order[0]} SENT TO SHIPPING DEPARTMENT")
+            order = self.orders.get()
+            self.ship_order(order[0])
+            # print(f"\n\t{order[0]} SENT TO SHIPPING DEPARTMENT")
 
 
 def main():